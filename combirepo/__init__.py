@@ -20,6 +20,7 @@
 
 __all__ = ["binfmt", "check", "commandline_parser", "config_parser",
            "dependency_graph_builder", "directory_downloader", "files",
-           "hidden_subprocess", "kickstart_parser", "parameters",
+           "hidden_subprocess", "kickstart_parser", "package_store",
+           "parameters", "repodata",
            "repository_combiner", "repository_manager", "repository_pair",
            "repository", "rpm_patcher", "strings", "temporaries", "__main__"]
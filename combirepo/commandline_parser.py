@@ -32,8 +32,10 @@ import rpm_patcher
 import config_parser
 from repository_pair import RepositoryPair
 import repository_combiner
+import dependency_graph_builder
 import files
 import repository_manager
+import directory_downloader
 
 man_format_remove = re.compile(r'(\\f\w)|(\n\.[A-Z]{2}\n?)')
 
@@ -170,7 +172,8 @@ class CommandlineParser():
             help="Use the custom config file instead of default one.")
         self._parser.add_argument(
             "-j", "--jobs", type=int, action="store", dest="jobs_number",
-            help="Number of parallel jobs", default=1)
+            help="Number of parallel jobs (also the number of files that "
+            "are downloaded simultaneously)", default=1)
 
     def __register_mic_related_options(self):
         """
@@ -244,6 +247,24 @@ class CommandlineParser():
             "--update-repository", action="append", type=str,
             dest="update_repositories", help="The repository URL that "
             "should be updated. Use word \"all\" to update all repositories")
+        self._parser.add_argument(
+            "--collect-garbage", action="store_true", default=False,
+            dest="collect_garbage", help="Remove packages that are not used "
+            "by any cached repository from the package store.")
+        self._parser.add_argument(
+            "--reachability-index", action="store_true", default=False,
+            dest="reachability_index", help="Precompute the reachability "
+            "index of dependency graphs and store it in the graph cache. It "
+            "takes memory quadratic in the number of packages, but makes "
+            "dependency closure queries instant.")
+        self._parser.add_argument(
+            "--lazy-graphs", action="store_true", default=False,
+            dest="lazy_graphs", help="Build dependency graphs only from "
+            "packages reachable from the packages of kickstart file and "
+            "read file lists of repositories only if some file requirements "
+            "are not resolved otherwise. Other packages are not included to "
+            "combined repositories. File conflicts between packages are not "
+            "checked unless the file lists have been read.")
 
     def __register_developer_options(self):
         """
@@ -336,6 +357,7 @@ class CommandlineParser():
 
         config_parser.initialize_config(arguments.config, gen_init_config)
         repository_combiner.jobs_number = arguments.jobs_number
+        directory_downloader.jobs_number = arguments.jobs_number
 
     def __build_repository_pairs(self, arguments):
         """
@@ -488,6 +510,12 @@ class CommandlineParser():
 
         if_regenerate = arguments.regenerate_repodata
         repository_combiner.repodata_regeneration_enabled = if_regenerate
+        if_collect = arguments.collect_garbage
+        repository_combiner.garbage_collection_enabled = if_collect
+        if_index = arguments.reachability_index
+        dependency_graph_builder.reachability_index_enabled = if_index
+        if_lazy = arguments.lazy_graphs
+        dependency_graph_builder.lazy_mode_enabled = if_lazy
 
         return parameters
 
@@ -22,17 +22,220 @@ import logging
 import os
 import sys
 import re
-from iniparse import ConfigParser
-import yum
+import time
+import errno
+import fcntl
+import hashlib
+import tempfile
+import cPickle
+from collections import deque
 import cStringIO
 from sets import Set
 import igraph
-import temporaries
+from rpmUtils.arch import getArchList
 import check
+import files
+import repodata
 import hidden_subprocess
 import scandir
 
 
+"""The path to directory with cached dependency graphs."""
+graph_cache_path = None
+
+
+"""The version of format of cached graphs (must be increased when the graph
+building changes)."""
+graph_cache_version = 14
+
+
+"""The number of recent graphs with the same building parameters that are
+considered as bases for the incremental graph update."""
+graph_bases_number = 8
+
+
+"""The time in seconds after which cached graphs that are not in any list of
+bases are removed (they can be used by concurrent runs before)."""
+graph_cache_grace_period = 3600
+
+
+"""Whether the reachability index of graphs should be precomputed."""
+reachability_index_enabled = False
+
+
+"""Whether graphs should contain only packages reachable from the package
+scope (the file lists of repositories are read in this mode only if file
+requirements cannot be resolved from the primary data)."""
+lazy_mode_enabled = False
+
+
+class SymbolProviders(object):
+    """
+    The compact storage of names of packages that provide symbols and files.
+    Packages are referred by integer IDs, and file paths are stored split
+    into directories and interned basenames, so that millions of full paths
+    are never kept in memory. Secondary indexes by basenames and by bare
+    names without "(...)" suffixes are used for fuzzy lookups.
+    """
+    def __init__(self):
+        """
+        Initializes the empty storage.
+        """
+        self._names = []
+        self._names_ids = {}
+        self._symbols = {}
+        self._directories = {}
+        self.build_indexes()
+
+    def __getstate__(self):
+        """
+        Gets the state for pickling, indexes are not saved since they are
+        rebuilt on loading.
+
+        @return         The state.
+        """
+        return (self._names, self._symbols, self._directories)
+
+    def __setstate__(self, state):
+        """
+        Restores the storage from the pickled state.
+
+        @param state    The state.
+        """
+        self._names, self._symbols, self._directories = state
+        self._names_ids = dict((name, name_id) for name_id, name
+                               in enumerate(self._names))
+        self.build_indexes()
+
+    def __get_name_id(self, name):
+        """
+        Gets the ID of the package name, registers it if needed.
+
+        @param name     The name of package.
+        @return         Its ID.
+        """
+        name_id = self._names_ids.get(name)
+        if name_id is None:
+            name_id = len(self._names)
+            self._names.append(name)
+            self._names_ids[name] = name_id
+        return name_id
+
+    def build_indexes(self):
+        """
+        Builds secondary indexes of symbols and files by their basenames and
+        bare basenames, it must be called after all providers are registered.
+        The indexes are not saved, so only IDs of packages are kept in them
+        for each basename.
+        """
+        basename_symbols = {}
+        bare_names = {}
+
+        def add_bare_names(basename, name_id):
+            position = basename.find('(')
+            while position >= 0:
+                bare_names.setdefault(basename[:position], []).append(name_id)
+                position = basename.find('(', position + 1)
+
+        for symbol, name_id in self._symbols.iteritems():
+            basename = os.path.basename(symbol)
+            basename_symbols.setdefault(basename, []).append(name_id)
+            add_bare_names(basename, name_id)
+        for basenames in self._directories.itervalues():
+            for basename, name_id in basenames.iteritems():
+                basename_symbols.setdefault(basename, []).append(name_id)
+                if '(' in basename:
+                    add_bare_names(basename, name_id)
+        self._basename_symbols = basename_symbols
+        self._bare_names = bare_names
+
+    def add_symbols(self, name, symbols):
+        """
+        Registers the package as the provider of the given symbols.
+
+        @param name     The name of package.
+        @param symbols  The list of symbols.
+        """
+        name_id = self.__get_name_id(name)
+        for symbol in symbols:
+            self._symbols[symbol] = name_id
+
+    def add_files(self, name, files):
+        """
+        Registers the package as the provider of the given files.
+
+        @param name     The name of package.
+        @param files    The list of file paths.
+        @return         The list of pairs (file path, package name) for files
+                        that were already provided by other packages.
+        """
+        name_id = self.__get_name_id(name)
+        conflicts = []
+        for path in files:
+            directory, basename = os.path.split(path)
+            basenames = self._directories.get(directory)
+            if basenames is None:
+                basenames = {}
+                self._directories[directory] = basenames
+            if isinstance(basename, str):
+                basename = intern(basename)
+            provider_id = basenames.get(basename)
+            if provider_id is not None and provider_id != name_id:
+                conflicts.append((path, self._names[provider_id]))
+            basenames[basename] = name_id
+        return conflicts
+
+    def get(self, symbol):
+        """
+        Gets the name of package that provides the given symbol or file.
+
+        @param symbol   The symbol or the file path.
+        @return         The name of package, or None if it is not found.
+        """
+        name_id = self._symbols.get(symbol)
+        if name_id is None:
+            directory, basename = os.path.split(symbol)
+            basenames = self._directories.get(directory)
+            if basenames is not None:
+                name_id = basenames.get(basename)
+        if name_id is None:
+            return None
+        return self._names[name_id]
+
+    def get_by_basename(self, basename):
+        """
+        Gets names of packages that provide symbols or files with the given
+        basename, or with the given bare basename followed by "(...)".
+
+        @param basename The basename.
+        @return         The list of package names.
+        """
+        names_ids = list(self._basename_symbols.get(basename, []))
+        names_ids.extend(self._bare_names.get(basename, []))
+        return [self._names[name_id] for name_id in names_ids]
+
+    def iteritems(self):
+        """
+        Iterates over all symbols and files with their providers.
+
+        @return         The generator of pairs (symbol, package name).
+        """
+        for symbol, name_id in self._symbols.iteritems():
+            yield symbol, self._names[name_id]
+        for directory, basenames in self._directories.iteritems():
+            for basename, name_id in basenames.iteritems():
+                yield os.path.join(directory, basename), self._names[name_id]
+
+    def __len__(self):
+        """
+        Gets the number of symbols and files.
+
+        @return         The number of symbols and files.
+        """
+        return len(self._symbols) + sum(
+            len(basenames) for basenames in self._directories.itervalues())
+
+
 class DependencyGraph(igraph.Graph):
     """
     Wrapper of igraph.Graph used for fast search of vertices by their names.
@@ -47,7 +250,12 @@ class DependencyGraph(igraph.Graph):
         self.id_names = {}
         self.provided_symbols = Set()
         self.unprovided_symbols = Set()
-        self.symbol_providers = {}
+        self.symbol_providers = SymbolProviders()
+        self.resolved_requirements = {}
+        self.file_conflicts = []
+        self.condensation = None
+        self.reachability = None
+        self.requirements_table = None
 
     def set_name_id(self, name, id_):
         """
@@ -66,10 +274,7 @@ class DependencyGraph(igraph.Graph):
 
         @return         The ID of package in the vertex list.
         """
-        if name in self.id_names.keys():
-            return self.id_names[name]
-        else:
-            return None
+        return self.id_names.get(name)
 
     def get_provider_names(self, symbol):
         """
@@ -81,21 +286,339 @@ class DependencyGraph(igraph.Graph):
         logging.debug("Getting provider for symbol {0}".format(symbol))
         logging.debug("Total number of symbols: "
                       "{0}".format(len(self.symbol_providers)))
-        names = []
         name = self.symbol_providers.get(symbol)
 
         if name is None:
-            for key in self.symbol_providers.keys():
-                key_basename = os.path.basename(key)
-                symbol_basename = os.path.basename(symbol)
-                if (key_basename == symbol_basename or
-                        (key_basename.startswith(symbol_basename) and
-                            key_basename[len(symbol_basename)] == '(')):
-                    names.append(self.symbol_providers[key])
+            names = self.symbol_providers.get_by_basename(
+                os.path.basename(symbol))
         else:
             names = [name]
         return names
 
+    def get_condensation(self):
+        """
+        Gets the condensation of the graph, i. e. the acyclic graph of its
+        strongly connected components. It is computed once and kept in the
+        graph.
+
+        @return         The tuple (membership, members, successors,
+                        predecessors), where membership maps vertex IDs to
+                        component IDs, members maps component IDs to lists of
+                        vertex IDs, successors and predecessors are adjacency
+                        lists of components.
+        """
+        if self.condensation is None:
+            clustering = self.clusters(mode=igraph.STRONG)
+            membership = clustering.membership
+            members = [list(component) for component in clustering]
+            successors = [Set() for component in members]
+            predecessors = [Set() for component in members]
+            for begin, end in self.get_edgelist():
+                component_begin = membership[begin]
+                component_end = membership[end]
+                if component_begin != component_end:
+                    successors[component_begin].add(component_end)
+                    predecessors[component_end].add(component_begin)
+            self.condensation = (membership, members,
+                                 [list(ends) for ends in successors],
+                                 [list(ends) for ends in predecessors])
+        return self.condensation
+
+    def get_requirements_table(self):
+        """
+        Gets the table of requirements of packages. It is computed once and
+        kept in the graph, so that requirements of packages from different
+        graphs are compared without decoding them again.
+
+        @return         The list indexed by vertex IDs of dictionaries that
+                        map required symbols to tuples (flags, epoch, version,
+                        release).
+        """
+        if self.requirements_table is None:
+            table = []
+            for requirements in self.vs["requirements"]:
+                row = {}
+                for symbol, flags, numbers in requirements:
+                    row[symbol] = (flags,) + tuple(numbers)
+                table.append(row)
+            self.requirements_table = table
+        return self.requirements_table
+
+    def get_reachability(self):
+        """
+        Gets the reachability index of the graph. For each component of the
+        condensation it contains the bitset of components reachable from it,
+        so that closures are computed without any traversal. It is computed
+        once and kept in the graph.
+
+        @return         The pair of lists of forward and backward bitsets
+                        (long integers where bit i is set if component i is
+                        reachable) indexed by component IDs.
+        """
+        if self.reachability is None:
+            membership, members, successors, predecessors = \
+                self.get_condensation()
+            order = _sort_topologically(successors, predecessors)
+            forward = [0] * len(members)
+            for component in reversed(order):
+                bits = 1 << component
+                for successor in successors[component]:
+                    bits |= forward[successor]
+                forward[component] = bits
+            backward = [0] * len(members)
+            for component in order:
+                bits = 1 << component
+                for predecessor in predecessors[component]:
+                    bits |= backward[predecessor]
+                backward[component] = bits
+            self.reachability = (forward, backward)
+        return self.reachability
+
+    def is_reachable(self, source, target, mode=igraph.OUT):
+        """
+        Checks whether one vertex is reachable from another one using the
+        reachability index.
+
+        @param source   The source vertex ID.
+        @param target   The target vertex ID.
+        @param mode     The direction, igraph.IN checks whether the source
+                        is a backward dependency of the target.
+        @return         True if the target is reachable.
+        """
+        forward, backward = self.get_reachability()
+        membership = self.condensation[0]
+        bitsets = forward if mode == igraph.OUT else backward
+        return bool(bitsets[membership[source]] >> membership[target] & 1)
+
+    def get_reachable(self, sources, mode=igraph.OUT, condensation=None):
+        """
+        Gets vertices reachable from the given ones with one multi-source
+        traversal. If the reachability index is computed, it is used instead
+        of the traversal.
+
+        @param sources      The list of vertex IDs.
+        @param mode         The direction of traversal, igraph.IN gives the
+                            backward dependencies.
+        @param condensation The condensation of the graph (see
+                            get_condensation), the traversal goes over it if
+                            it is given.
+        @return             The bitmap of vertex IDs (bytearray where
+                            reachable vertices, including sources, are
+                            marked with 1).
+        """
+        if self.reachability is not None:
+            membership, members, _, _ = self.condensation
+            forward, backward = self.reachability
+            bitsets = forward if mode == igraph.OUT else backward
+            bits = 0
+            for source in sources:
+                bits |= bitsets[membership[source]]
+            # The bitset is converted to marks of components with the
+            # conversion to the binary string that is done in C:
+            components_marks = [digit == "1" for digit
+                                in reversed(bin(bits)[2:])]
+        elif condensation is None:
+            return _mark_reachable(self.get_adjlist(mode=mode), sources)
+        else:
+            membership, members, successors, predecessors = condensation
+            adjacency = successors if mode == igraph.OUT else predecessors
+            components_marks = _mark_reachable(
+                adjacency, [membership[source] for source in sources])
+        marks = bytearray(self.vcount())
+        for component, mark in enumerate(components_marks):
+            if mark:
+                for vertex in members[component]:
+                    marks[vertex] = 1
+        return marks
+
+    def get_state(self):
+        """
+        Gets the state of the graph that is enough to restore it.
+
+        @return         The dictionary with edges, vertex attributes and
+                        symbol sets of the graph.
+        """
+        state = {}
+        state["vertices_number"] = self.vcount()
+        state["edges"] = self.get_edgelist()
+        state["attributes"] = dict((attribute, self.vs[attribute]) for
+                                   attribute in self.vs.attributes())
+        state["id_names"] = self.id_names
+        state["provided_symbols"] = self.provided_symbols
+        state["unprovided_symbols"] = self.unprovided_symbols
+        state["symbol_providers"] = self.symbol_providers
+        state["resolved_requirements"] = self.resolved_requirements
+        state["file_conflicts"] = self.file_conflicts
+        state["condensation"] = self.condensation
+        state["reachability"] = self.reachability
+        state["requirements_table"] = self.requirements_table
+        return state
+
+    @staticmethod
+    def from_state(state):
+        """
+        Restores the graph from the given state.
+
+        @param state    The state of the graph.
+        @return         The dependency graph.
+        """
+        graph = DependencyGraph()
+        graph.add_vertices(state["vertices_number"])
+        graph.add_edges(state["edges"])
+        for attribute, values in state["attributes"].iteritems():
+            graph.vs[attribute] = values
+        graph.id_names = state["id_names"]
+        graph.provided_symbols = state["provided_symbols"]
+        graph.unprovided_symbols = state["unprovided_symbols"]
+        graph.symbol_providers = state["symbol_providers"]
+        graph.resolved_requirements = state["resolved_requirements"]
+        graph.file_conflicts = state["file_conflicts"]
+        graph.condensation = state["condensation"]
+        graph.reachability = state["reachability"]
+        graph.requirements_table = state["requirements_table"]
+        return graph
+
+
+def _mark_reachable(adjacency, sources):
+    """
+    Marks vertices reachable from the given ones.
+
+    @param adjacency    The adjacency lists of the graph.
+    @param sources      The list of source vertex IDs.
+    @return             The bitmap of reachable vertex IDs.
+    """
+    marks = bytearray(len(adjacency))
+    worklist = deque()
+    for source in sources:
+        if not marks[source]:
+            marks[source] = 1
+            worklist.append(source)
+    while len(worklist) > 0:
+        for vertex in adjacency[worklist.popleft()]:
+            if not marks[vertex]:
+                marks[vertex] = 1
+                worklist.append(vertex)
+    return marks
+
+
+def _sort_topologically(successors, predecessors):
+    """
+    Sorts vertices of the acyclic graph topologically.
+
+    @param successors   The adjacency lists of successors.
+    @param predecessors The adjacency lists of predecessors.
+    @return             The list of vertex IDs where each vertex precedes
+                        its successors.
+    """
+    degrees = [len(vertices) for vertices in predecessors]
+    order = [vertex for vertex, degree in enumerate(degrees) if degree == 0]
+    for vertex in order:
+        for successor in successors[vertex]:
+            degrees[successor] -= 1
+            if degrees[successor] == 0:
+                order.append(successor)
+    return order
+
+
+def _load_state(path):
+    """
+    Loads the pickled state from the cache.
+
+    @param path     The path to the cache file.
+    @return         The state, or None if the cache cannot be used.
+    """
+    try:
+        with open(path, "rb") as cache_file:
+            return cPickle.load(cache_file)
+    except (IOError, EOFError, cPickle.UnpicklingError) as error:
+        if not (isinstance(error, IOError) and error.errno == errno.ENOENT):
+            logging.warning("Failed to load cached state {0}: "
+                            "{1}".format(path, error))
+        return None
+
+
+def _load_bases(path):
+    """
+    Loads the list of bases for the incremental update.
+
+    @param path     The path to the cache file.
+    @return         The list of names of cached graphs, it is empty if the
+                    list has been saved by another version of the cache.
+    """
+    state = _load_state(path)
+    if not isinstance(state, dict) or state["version"] != graph_cache_version:
+        return []
+    return state["bases"]
+
+
+def _lock_bases(path):
+    """
+    Locks the list of bases against other builds that use the same cache.
+    The lock is taken on the separate file, because the list itself is
+    replaced on each write.
+
+    @param path     The path to the list of bases.
+    @return         The lock file, the lock is released when it is closed.
+    """
+    lock_file = open(path + ".lock", "a")
+    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+    return lock_file
+
+
+def _remove_stale_cache_files():
+    """
+    Removes files of cached graphs that are not in any list of bases of the
+    current version of the cache, as well as the lists of bases of previous
+    versions.
+    """
+    global graph_cache_path
+    global graph_cache_grace_period
+    referenced_names = Set()
+    names = os.listdir(graph_cache_path)
+    for name in names:
+        if name.endswith(".bases"):
+            path = os.path.join(graph_cache_path, name)
+            state = _load_state(path)
+            if (isinstance(state, dict) and
+                    state["version"] == graph_cache_version):
+                referenced_names.update(state["bases"])
+            else:
+                logging.debug("Removing stale list of bases {0}".format(path))
+                files.safe_remove(path)
+    deadline = time.time() - graph_cache_grace_period
+    for name in names:
+        cache_name, extension = os.path.splitext(name)
+        if (extension not in [".graph", ".packages"] or
+                cache_name in referenced_names):
+            continue
+        path = os.path.join(graph_cache_path, name)
+        try:
+            if os.path.getmtime(path) >= deadline:
+                continue
+        except OSError:
+            # It has been removed by the concurrent run:
+            continue
+        logging.debug("Removing stale cached graph {0}".format(path))
+        files.safe_remove(path)
+
+
+def _save_state(state, path):
+    """
+    Saves the pickled state to the cache. The file is replaced atomically,
+    so that concurrent runs never read it partially written.
+
+    @param state    The state.
+    @param path     The path to the cache file.
+    """
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    descriptor, temporary_path = tempfile.mkstemp(
+        prefix=os.path.basename(path), dir=directory)
+    with os.fdopen(descriptor, "wb") as cache_file:
+        cPickle.dump(state, cache_file, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temporary_path, path)
+
 
 def _get_full_package_name(package):
     """
@@ -103,7 +626,7 @@ def _get_full_package_name(package):
 
     name-1.1.1-1.1.armv7l
 
-    @param package  YUM package object from YUM package sack.
+    @param package  The package record from the repository metadata.
 
     @return         Full package name.
     """
@@ -283,12 +806,13 @@ def _handle_have_choice_problem(requirement, providers, preferables, strategy):
     return provider
 
 
-def _search_dependencies(yum_sack, package, providers, preferables, strategy,
+def _search_dependencies(resolved, package, providers, preferables, strategy,
                          packages_list = None):
     """
     Searches the dependencies of the given package in the repository
 
-    @param yum_sack     The YUM sack used to search packages.
+    @param resolved     The dictionary that maps requirements to lists of
+                        their candidate providers.
     @param package      The package which dependencies are searched.
     @param providers    Cached RPM symbols providers.
     @param strategy     Have choice resolving strategy.
@@ -303,7 +827,7 @@ def _search_dependencies(yum_sack, package, providers, preferables, strategy,
     provided_symbols = Set()
     unprovided_symbols = Set()
 
-    for requirement in package.returnPrco('requires'):
+    for requirement in package.requires:
         logging.debug("   requirement: {0}".format(requirement))
         requirement_name = requirement[0]
 
@@ -313,18 +837,17 @@ def _search_dependencies(yum_sack, package, providers, preferables, strategy,
         # Search the provider.
         # If the provider is already cached, use it to speed up the
         # search
-        if requirement_name in providers:
-            provider = providers[requirement_name]
+        if requirement in providers:
+            provider = providers[requirement]
+            provided_symbols.add(requirement_name)
         else:
-            provider = yum_sack.searchProvides(requirement_name)
+            provider = resolved[requirement]
 
             if not provider:
-                element = Set([requirement_name])
-                unprovided_symbols = unprovided_symbols | element
+                unprovided_symbols.add(requirement_name)
                 continue
             else:
-                element = Set([requirement_name])
-                provided_symbols = provided_symbols | element
+                provided_symbols.add(requirement_name)
                 if len(provider) != 1:
                     providers_count = 0
                     proper_provider = None
@@ -343,7 +866,7 @@ def _search_dependencies(yum_sack, package, providers, preferables, strategy,
                 else:
                     provider = provider[0].name
 
-        providers[requirement_name] = provider
+        providers[requirement] = provider
 
         if provider == package.name:
             dependencies[provider] = None
@@ -376,8 +899,8 @@ def dependency_graph_building_status():
 
 class DependencyGraphBuilder():
     """
-    The builder of package dependency tree. Uses YUM as the repository
-    parser. Based on repo-graph.py from yum-utils.
+    The builder of package dependency tree. Reads the repodata of the
+    repository directly. Based on repo-graph.py from yum-utils.
     """
 
     def __init__(self, package_name_checking_function, packages=None):
@@ -420,20 +943,51 @@ class DependencyGraphBuilder():
         self.preferables.extend(preferables)
         self.strategy = strategy
         # If the relative path is given, transform it to the absolute path,
-        # because it will be written to the config file.
+        # because it is a part of the graph cache key.
         repository_path = os.path.abspath(repository_path)
 
         check.directory_exists(repository_path)
         self.repository_path = repository_path
-
-        # Create the unique repository ID.
-        repoid = "analyzed-repo-{0}".format(os.getpid())
-
-        config_path = self.__build_yum_config(repoid)
         self.arch = arch
-        yum_base = self.__setup_yum_base(config_path, repoid, self.arch)
-        graph, back_graph = self.__build_dependency_graph(yum_base,
-                                                          packages_list)
+
+        cache_name, bases_name = self.__get_cache_names(packages_list)
+        global reachability_index_enabled
+        if cache_name is not None:
+            state = _load_state(self.__get_cache_path(cache_name, "graph"))
+            if state is not None:
+                logging.info("Dependency graph of {0} is loaded from "
+                             "cache".format(repository_path))
+                graph = DependencyGraph.from_state(state)
+                if reachability_index_enabled and graph.reachability is None:
+                    # The graph has been cached without the index:
+                    graph.get_reachability()
+                    _save_state(graph.get_state(),
+                                self.__get_cache_path(cache_name, "graph"))
+                self.__add_base(cache_name, bases_name)
+                return graph
+
+        global lazy_mode_enabled
+        metadata = repodata.RepositoryMetadata(
+            repository_path, getArchList(self.arch),
+            file_lists=not lazy_mode_enabled)
+        packages_checksums = dict((package.checksum, package.name) for package
+                                  in metadata.get_packages())
+        providers = {}
+        if cache_name is not None:
+            providers = self.__get_base_providers(metadata, packages_checksums,
+                                                  bases_name)
+        graph = self.__build_dependency_graph(metadata, providers,
+                                              packages_list)
+        graph.get_condensation()
+        graph.get_requirements_table()
+        if reachability_index_enabled:
+            graph.get_reachability()
+        if cache_name is not None:
+            _save_state(graph.get_state(),
+                        self.__get_cache_path(cache_name, "graph"))
+            _save_state(packages_checksums,
+                        self.__get_cache_path(cache_name, "packages"))
+            self.__add_base(cache_name, bases_name)
 
         if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
             logging.debug("{0}".format(igraph.summary(graph)))
@@ -445,136 +999,182 @@ class DependencyGraphBuilder():
             logging.debug("The graph was exported in DOT format to "
                           "file {0}".format(dot_file_name))
 
-        return graph, back_graph
+        return graph
 
-    def __build_yum_config(self, repoid):
+    def __get_cache_names(self, packages_list):
         """
-        Builds the YUM config that will be used for YUM initialization.
-
-        @param repoid   The ID of repository to be analyzed.
-
-        @return The path to generated YUM config file.
+        Gets names of cache files of the analyzed repository. The graph is
+        identified by packages of the repository and by all parameters
+        that affect the graph building. Graphs built with the same parameters
+        share the list of bases for the incremental update.
+
+        @param packages_list    The list of packages to be downloaded.
+        @return                 The pair of the name of cached graph and the
+                                name of list of bases, or the pair of None if
+                                the graph cannot be cached.
         """
-        config_path = temporaries.create_temporary_file("yum.conf")
-        config = ConfigParser()
-        # FIXME: This config was get from my Ubuntu default yum config, maybe
-        # we should somehow modify it.
-        config.add_section("main")
-        cache_path = temporaries.create_temporary_directory("yum.cache")
-        config.set("main", "cachedir", cache_path)
-        config.set("main", "keepcache", "1")
-        config.set("main", "debuglevel", "2")
-        log_path = temporaries.create_temporary_file("yum.log")
-        config.set("main", "logfile", log_path)
-        # FIXME: Is this a reason why ARM RPMs are ignored?
-        config.set("main", "exactarch", "1")
-        config.set("main", "obsoletes", "1")
-
-        config.add_section(repoid)
-        config.set(repoid, "name", "Analyzed repository")
-        config.set(repoid, "baseurl",
-                   "file://{0}".format(self.repository_path))
-
-        with open(config_path, "w") as config_file:
-            config.write(config_file)
-            config_file.close()
-
-        return config_path
-
-    def __setup_yum_base(self, config_path, repoid, arch):
+        global graph_cache_path
+        if graph_cache_path is None:
+            return None, None
+        # The repodata is not hashed as is, because it changes each time it
+        # is regenerated, even for the same packages:
+        checksums = repodata.read_packages_checksums(self.repository_path)
+        if checksums is None:
+            return None, None
+        # The repository path is not a part of parameters, because snapshots
+        # of the same repository are downloaded to different directories:
+        global lazy_mode_enabled
+        key = [graph_cache_version, lazy_mode_enabled, self.arch,
+               self.strategy, sorted(Set(self.preferables)),
+               sorted(Set(self.packages)) if self.packages else None,
+               sorted(Set(packages_list)) if packages_list else None]
+        bases_name = hashlib.sha256(repr(key)).hexdigest()
+        hasher = hashlib.sha256()
+        hasher.update(repr([checksums, self.repository_path, key]))
+        return hasher.hexdigest(), bases_name
+
+    def __get_cache_path(self, name, extension):
         """
-        Sets the yum base up.
-
-        @param config_path  The path to the YUM config file to be used.
-        @param repoid       The ID of repository to be analyzed.
-        @param arch             The architecture to be analyzed
+        Gets the path to the cache file.
 
-        @return The YUM base ready for querring.
+        @param name         The name of cache file.
+        @param extension    The extension of cache file.
+        @return             The path to the cache file.
         """
-        yum_base = yum.YumBase()
-        yum_base.arch.setup_arch(arch)
-        yum_base.doConfigSetup(config_path)
+        global graph_cache_path
+        return os.path.join(graph_cache_path, "{0}.{1}".format(name,
+                                                               extension))
 
-        try:
-            # Disable all repositories except one that should be analyzed.
-            for repo in yum_base.repos.findRepos('*'):
-                if repo.id != repoid:
-                    repo.disable()
-                else:
-                    repo.enable()
-
-            yum_base.doRepoSetup()
-            yum_base.doTsSetup()
-            yum_base.doSackSetup()
-
-        except yum.Errors.YumBaseError as error:
-            logging.error("YUM error happened: {0}".format(error))
-            config_file_content = open(config_path).read()
-            logging.error("The following config file was "
-                          "used:\n{0}".format(config_file_content))
-            sys.exit(1)
+    def __add_base(self, cache_name, bases_name):
+        """
+        Adds the cached graph to the list of recent bases for the incremental
+        update. Graphs that drop out of the list are removed from the cache.
 
-        return yum_base
+        @param cache_name   The name of cached graph.
+        @param bases_name   The name of list of bases.
+        """
+        bases_path = self.__get_cache_path(bases_name, "bases")
+        # The original and marked repositories can be built concurrently
+        # with the same list of bases:
+        with _lock_bases(bases_path):
+            bases = _load_bases(bases_path)
+            if cache_name in bases:
+                bases.remove(cache_name)
+            bases.append(cache_name)
+            global graph_bases_number
+            for name in bases[:-graph_bases_number]:
+                for extension in ["graph", "packages"]:
+                    files.safe_remove(self.__get_cache_path(name, extension))
+            _save_state({"version": graph_cache_version,
+                         "bases": bases[-graph_bases_number:]}, bases_path)
+        _remove_stale_cache_files()
+
+    def __get_base_providers(self, metadata, packages_checksums, bases_name):
+        """
+        Gets resolved requirements that can be reused from the most similar
+        recent graph built with the same parameters. Resolutions that involve
+        added, removed or changed packages are dropped, so only requirements
+        affected by the changes are resolved again.
+
+        @param metadata             The repository metadata.
+        @param packages_checksums   The dictionary that maps checksums of
+                                    packages of the repository to their names.
+        @param bases_name           The name of list of bases.
+        @return                     The dictionary that maps requirements to
+                                    names of their providers.
+        """
+        bases = _load_bases(self.__get_cache_path(bases_name, "bases"))
+        base_name = None
+        affected_names = None
+        for name in reversed(bases):
+            base_checksums = _load_state(self.__get_cache_path(name,
+                                                               "packages"))
+            if base_checksums is None:
+                continue
+            names = Set()
+            for checksums, other_checksums in [
+                    (packages_checksums, base_checksums),
+                    (base_checksums, packages_checksums)]:
+                for checksum, package_name in checksums.iteritems():
+                    if checksum not in other_checksums:
+                        names.add(package_name)
+            if affected_names is None or len(names) < len(affected_names):
+                base_name = name
+                affected_names = names
+        # The update is not worth it if the most of packages are changed:
+        if (base_name is None or
+                2 * len(affected_names) > len(packages_checksums)):
+            return {}
+        state = _load_state(self.__get_cache_path(base_name, "graph"))
+        if state is None:
+            return {}
+        affected_symbols = Set()
+        for package in metadata.get_packages():
+            if package.name in affected_names:
+                affected_symbols.update(package.provides_names)
+                affected_symbols.update(package.files)
+                affected_symbols.update(package.other_files)
+        providers = {}
+        for requirement, provider in state["resolved_requirements"].iteritems():
+            if (provider not in affected_names and
+                    requirement[0] not in affected_symbols):
+                providers[requirement] = provider
+        logging.info("Dependency graph of {0} is updated incrementally, {1} "
+                     "packages are changed".format(self.repository_path,
+                                                   len(affected_names)))
+        return providers
+
+    def __list_package_files(self):
+        """
+        Lists RPM files of the analyzed repository once, so that packages
+        that are not found at their repodata locations can be found without
+        walking the repository again.
 
-    def __find_package_location(self, package):
+        @return The pair of the set of RPM file paths and the dictionary that
+                maps RPM file names to paths.
+        """
+        paths = Set()
+        paths_by_names = {}
+        for root, dirs, files in scandir.walk(self.repository_path):
+            for file_name in files:
+                if file_name.endswith(".rpm"):
+                    path = os.path.join(root, file_name)
+                    paths.add(path)
+                    paths_by_names.setdefault(file_name, path)
+        return paths, paths_by_names
+
+    def __find_package_location(self, package, package_files):
         """
         Looks for the package location inside the analyzed repository.
 
-        @param package  The package to be found.
+        @param package          The package to be found.
+        @param package_files    The listing of RPM files of the repository.
 
         @return The full path to the package file.
         """
-        # FIXME: Currently YUM information about RPM location inside the given
-        # repository is not accessible. That's why we mannualy search files in
-        # the repository.
-
-        package_name = _get_full_package_name(package)
-        file_name = "{0}.rpm".format(package_name)
-
-        # Check most probably paths to speed up the search.
-        # This gives speed up from 10.760s to 0.711s of program run time.
-        location = os.path.join(self.repository_path, self.arch, file_name)
-        if os.path.exists(location):
-            return location
-
-        location = os.path.join(self.repository_path, "noarch", file_name)
-        if os.path.exists(location):
+        paths, paths_by_names = package_files
+        location = os.path.normpath(os.path.join(self.repository_path,
+                                                 package.location))
+        if location in paths:
             return location
 
-        location = os.path.join(self.repository_path, file_name)
-        if os.path.exists(location):
-            return location
-
-        location = None
-        for root, dirs, files in scandir.walk(self.repository_path):
-            for existing_file_name in files:
-                if package_name in existing_file_name:
-                    location = os.path.join(self.repository_path,
-                                            existing_file_name)
-
+        file_name = "{0}.rpm".format(_get_full_package_name(package))
+        location = paths_by_names.get(os.path.basename(package.location),
+                                      paths_by_names.get(file_name))
         if location is None:
             raise Exception("Failed to find package {0}!".format(package))
-        else:
-            return location
+        return location
 
-    def __build_vertex(self, package, names, full_names, locations,
-                       versions, releases, requirements, packages, yum_sack,
-                       graph, back_graph):
+    def __select_package(self, package, names, packages, metadata):
         """
-        Builds the vertex of dependency graph that corresponds to the given
-        package.
+        Selects the package for the vertex of dependency graph, if it passes
+        the checks and is preferred over other packages with the same name.
 
         @param package          The package.
-        @param names            The list of package names.
-        @param full_names       The list of package full names.
-        @param locations        The list of package locations.
-        @param versions         The list of package versions.
-        @param releases         The list of package releases.
-        @param requirements     The list of package requirements.
-        @param packages         The list of package objects.
-        @param yum_sack         The YUM sack.
-        @param graph            The forward dependency graph.
-        @param back_graph       The backward dependency graph.
+        @param names            The list of names of selected packages.
+        @param packages         The dictionary that maps names to selected
+                                packages.
+        @param metadata         The repository metadata.
         """
         full_name = _get_full_package_name(package)
         logging.debug("Processing package {0} with full name "
@@ -583,240 +1183,261 @@ class DependencyGraphBuilder():
             logging.debug("Check with name function...")
             if not self.name_checking_function(full_name):
                 return
-        location = self.__find_package_location(package)
         # We should not include "dontuse" rpms to index at all, so delete
         # it from there:
-        if "dontuse.rpm" in location:
-            yum_sack.delPackage(package)
+        if "dontuse.rpm" in package.location:
+            metadata.remove_package(package)
             return
-        if package.name in names:
-            name_id = graph.get_name_id(package.name)
-            added_package = packages[name_id]
+        if package.name in packages:
+            added_package = packages[package.name]
             if self.strategy is not None:
                 extreme_package = _get_extreme_package(
                     [package, added_package], self.strategy)
                 if extreme_package == added_package:
                     logging.debug("Already in lists.")
-                    yum_sack.delPackage(package)
+                    metadata.remove_package(package)
                 else:
-                    yum_sack.delPackage(added_package)
-                    full_names[name_id] = full_name
-                    locations[name_id] = location
-                    versions[name_id] = package.version
-                    releases[name_id] = package.release
-                    packages[name_id] = package
+                    metadata.remove_package(added_package)
+                    packages[package.name] = package
                     logging.debug("Replaced with proper package.")
         else:
-            i = len(names)
-            graph.set_name_id(package.name, i)
-            back_graph.set_name_id(package.name, i)
             names.append(package.name)
-            full_names.append(full_name)
-            locations.append(location)
-            versions.append(package.version)
-            releases.append(package.release)
             logging.debug("Package {0} requires following "
                           "symbols:".format(package.name))
             for requirement in package.requires:
                 logging.debug(" * {0}".format(requirement))
-            requirements.append(package.requires)
-            packages.append(package)
+            packages[package.name] = package
 
-    def __build_dependency_graph_vertices(self, yum_base):
+    def __select_packages(self, metadata):
         """
-        Builds vertices of repository dependency graph.
+        Selects packages that will be represented by vertices of dependency
+        graph, one package per name.
 
-        @param yum_base     The YUM base.
-        @return             Forward and backward dependency graphs
-                            (with vertices only).
+        @param metadata     The repository metadata.
+        @return             The list of selected packages.
         """
-        graph = DependencyGraph()
-        back_graph = DependencyGraph()
+        names = []
+        packages = {}
+        tasks = []
+        for package in metadata.get_packages():
+            tasks.append((package.name, package, names, packages, metadata))
+        hidden_subprocess.function_call_list(
+            "Selecting packages", self.__select_package, tasks)
+        return [packages[name] for name in names]
 
-        yum_sack = yum_base.pkgSack
+    def __build_dependency_graph_vertices(self, packages):
+        """
+        Builds vertices of repository dependency graph.
 
-        # Remember IDs of packages in the hash.
-        id_packages = {}
-        i = 0
-        packages = yum_sack.returnPackages()
+        @param packages     The list of selected packages.
+        @return             The dependency graph (with vertices only).
+        """
+        graph = DependencyGraph()
+        package_files = self.__list_package_files()
+        for i, package in enumerate(packages):
+            graph.set_name_id(package.name, i)
         graph.add_vertices(len(packages))
-        back_graph.add_vertices(len(packages))
-        tasks = []
-        names = []
-        full_names = []
-        locations = []
-        versions = []
-        releases = []
-        requirements = []
-        added_packages = []
-        for package in packages:
-            task = (package.name, package, names, full_names, locations,
-                    versions, releases, requirements, added_packages, yum_sack,
-                    graph, back_graph)
-            tasks.append(task)
-        hidden_subprocess.function_call_list(
-            "Building vertices", self.__build_vertex, tasks)
-        for i in range(len(names)):
-            name_id = graph.get_name_id(names[i])
-            if i != name_id:
-                raise Exception("name id = {0} for package #{1}".format(
-                    name_id, i))
-        graph.vs["name"] = names
-        graph.vs["full_name"] = full_names
-        graph.vs["location"] = locations
-        graph.vs["version"] = versions
-        graph.vs["release"] = releases
-        graph.vs["requirements"] = requirements
-        back_graph.vs["name"] = names
-        back_graph.vs["full_name"] = full_names
-        back_graph.vs["location"] = locations
-        back_graph.vs["version"] = versions
-        back_graph.vs["release"] = releases
-        back_graph.vs["requirements"] = requirements
-        return graph, back_graph
-
-    def __build_dependency_graph_edges(self, yum_base, graph, back_graph,
+        graph.vs["name"] = [package.name for package in packages]
+        graph.vs["full_name"] = [_get_full_package_name(package)
+                                 for package in packages]
+        graph.vs["location"] = [
+            self.__find_package_location(package, package_files)
+            for package in packages]
+        graph.vs["version"] = [package.version for package in packages]
+        graph.vs["release"] = [package.release for package in packages]
+        graph.vs["requirements"] = [package.requires for package in packages]
+        return graph
+
+    def __build_dependency_graph_edges(self, metadata, packages, providers,
                                        packages_list = None):
         """
-        Builds the edges of dependency graphs.
-
-        @param yum_base         The YUM base.
-        @param graph            The forward dependency graph.
-        @param back_graph       The backward dependency graph.
-        @return                 Forward and backward edges.
+        Builds the edges of dependency graphs, i. e. resolves the
+        dependencies of packages reachable from the package scope.
+
+        @param metadata         The repository metadata.
+        @param packages         The list of selected packages.
+        @param providers        The dictionary that maps already resolved
+                                requirements to names of their providers.
+        @return                 The tuple of the set of names of reachable
+                                packages, the list of edges as pairs of
+                                names, sets of provided and unprovided
+                                symbols and the dictionary of resolved
+                                requirements.
         """
         logging.debug("Begin building edges...")
-        providers = {}
+        providers = dict(providers)
         edges = []
-        back_edges = []
-        yum_sack = yum_base.pkgSack
-        packages_scope_initial = self.packages
-        package_names = [package.name for package in yum_sack.returnPackages()]
+        provided_symbols = Set()
+        unprovided_symbols = Set()
+        packages_by_names = dict((package.name, package) for package
+                                 in packages)
         if self.packages is None or len(self.packages) == 0:
-            self.packages = package_names
+            self.packages = packages_by_names.keys()
             logging.error("No package scope for the given repository has been "
                           "specified!")
-        packages_scope = Set(self.packages)
-        for package_name in packages_scope:
-            if package_name not in package_names:
-                packages_scope = packages_scope - Set([package_name])
-        packages_processed = Set([])
-        while len(packages_processed) < len(packages_scope):
-            logging.debug("Processed {0} packages from "
-                          "{1}".format(len(packages_processed),
-                                       len(packages_scope)))
-            logging.debug("   Remaining: "
-                          "{0}".format(packages_scope - packages_processed))
-            for package in yum_sack.returnPackages():
-                if package.name in packages_processed:
-                    continue
-                if package.name not in packages_scope:
-                    logging.debug(" * Package {0} is still not "
-                                  "processed.".format(package.name))
-                    continue
-                dependencies, provided, unprovided = _search_dependencies(
-                    yum_sack, package, providers, self.preferables,
-                    self.strategy, packages_list)
-
-                provided = graph.provided_symbols | provided
-                unprovided = graph.unprovided_symbols | unprovided
-                graph.provided_symbols = provided
-                graph.unprovided_symbols = unprovided
-
-                for dependency in dependencies:
-                    id_begin = graph.get_name_id(package.name)
-                    id_end = graph.get_name_id(dependency)
-                    edges.append((id_begin, id_end))
-                    back_edges.append((id_end, id_begin))
-                    if (dependency not in packages_scope and
-                            dependency not in packages_processed):
-                        packages_scope = packages_scope | Set([dependency])
-                        global packages_number_total
-                        packages_number_total = len(packages_scope)
-                packages_processed = packages_processed | Set([package.name])
-                global package_name_last_processed
-                package_name_last_processed = package.name
-                global packages_number_done
-                packages_number_done = len(packages_processed)
-        graph.add_edges(edges)
-        back_graph.add_edges(back_edges)
-        providers = {}
-        for package in yum_sack.returnPackages():
-            for symbol in package.provides_names:
-                providers[symbol] = package.name
-            for file_name in package.filelist:
-                providers[file_name] = package.name
-        graph.symbol_providers = providers
-        back_graph.symbol_providers = providers
-        hidden_subprocess.function_call(
-            "Inspecting file conflicts",
-            self.__check_file_conflicts, yum_sack.returnPackages(),
-            packages_scope_initial)
-
-    def __check_file_conflicts(self, packages, packages_scope):
+        # The scope is extended with dependencies of processed packages until
+        # its closure is reached, each package is processed only once:
+        packages_scope = Set([name for name in self.packages
+                              if name in packages_by_names])
+        # Requirements of all packages are resolved at once against the
+        # index of provides:
+        requirements = []
+        for package in packages:
+            for requirement in package.requires:
+                if requirement not in providers:
+                    requirements.append(requirement)
+        resolved = metadata.resolve_requirements(requirements)
+        worklist = deque(packages_scope)
+        global packages_number_total
+        packages_number_total = len(packages_scope)
+        global packages_number_done
+        packages_number_done = 0
+        while len(worklist) > 0:
+            package = packages_by_names[worklist.popleft()]
+            dependencies, provided, unprovided = _search_dependencies(
+                resolved, package, providers, self.preferables,
+                self.strategy, packages_list)
+            provided_symbols |= provided
+            unprovided_symbols |= unprovided
+
+            for dependency in dependencies:
+                edges.append((package.name, dependency))
+                if (dependency not in packages_scope and
+                        dependency in packages_by_names):
+                    packages_scope.add(dependency)
+                    worklist.append(dependency)
+            packages_number_total = len(packages_scope)
+            global package_name_last_processed
+            package_name_last_processed = package.name
+            packages_number_done += 1
+        logging.debug("Processed {0} packages".format(packages_number_done))
+        return (packages_scope, edges, provided_symbols, unprovided_symbols,
+                providers)
+
+    def __collect_symbol_providers(self, packages, packages_scope):
         """
-        Checks file conflicts between packages.
+        Collects providers of symbols and files and detects file conflicts
+        that involve packages from the scope. Files are stored by
+        directories, so a conflict is detected by one lookup when the file
+        is registered for the second time.
 
         @param packages         The list of packages.
         @param packages_scope   The installed packages.
+        @return                 The pair of providers of symbols and files
+                                and the report of file conflicts.
         """
-        providers = {}
+        symbol_providers = SymbolProviders()
+        if packages_scope is not None:
+            packages_scope = Set(packages_scope)
         providers_conflicts = {}
         for package in packages:
-            symbols = package.filelist
-            for symbol in symbols:
-                provider = providers.get(symbol)
-                if (provider is not None and
-                        provider != package.name and
-                        package.name in packages_scope):
-                    if providers_conflicts.get(symbol) is None:
-                        providers_conflicts[symbol] = []
-                        providers_conflicts[symbol].append(providers[symbol])
-                        providers_conflicts[symbol].append(package.name)
-                    else:
-                        providers_conflicts[symbol].append(package.name)
-                providers[symbol] = package.name
+            symbol_providers.add_symbols(package.name, package.provides_names)
+            conflicts = symbol_providers.add_files(package.name, package.files)
+            if packages_scope is None:
+                continue
+            for path, provider in conflicts:
+                if (package.name in packages_scope or
+                        provider in packages_scope):
+                    providers = providers_conflicts.setdefault(path, Set())
+                    providers.add(provider)
+                    providers.add(package.name)
+        symbol_providers.build_indexes()
+        report = self.__check_file_conflicts(providers_conflicts,
+                                             packages_scope)
+        return symbol_providers, report
+
+    def __check_file_conflicts(self, providers_conflicts, packages_scope):
+        """
+        Checks file conflicts between packages and builds the report about
+        them. Conflicts are critical if several conflicting packages are in
+        the scope.
+
+        @param providers_conflicts  The dictionary that maps conflicting files
+                                    to sets of names of packages that provide
+                                    them.
+        @param packages_scope       The set of installed packages.
+        @return                     The list of conflicts, each of them is
+                                    the dictionary with keys "packages"
+                                    (sorted tuple of package names), "files"
+                                    (sorted list of paths) and "critical".
+        """
         conflicts = {}
-        for symbol in providers_conflicts.keys():
-            conflict = tuple(sorted(providers_conflicts[symbol]))
-            if conflict in conflicts.keys():
-                conflicts[conflict].append(symbol)
+        for path, providers in providers_conflicts.iteritems():
+            conflicts.setdefault(tuple(sorted(providers)), []).append(path)
+
+        report = []
+        for names in sorted(conflicts.keys()):
+            degree = len([name for name in names if name in packages_scope])
+            report.append({"packages": names,
+                           "files": sorted(conflicts[names]),
+                           "critical": degree > 1})
+
+        for conflict in report:
+            message = ("Packages {0} have {1} conflicting files, e. g. "
+                       "{2}".format(", ".join(conflict["packages"]),
+                                    len(conflict["files"]),
+                                    conflict["files"][0]))
+            if conflict["critical"]:
+                logging.error(message)
             else:
-                conflicts[conflict] = [symbol]
-
-        scope_conflicts = {}
-        for conflict in conflicts.keys():
-            logging.warning(
-                "Packages {0} have {1} "
-                "conflicts:".format(", ".join(conflict),
-                                    len(conflicts[conflict])))
-            for symbol in conflicts[conflict]:
-                logging.warning(" * {0}".format(symbol))
-            degree = 0
-            if packages_scope is not None:
-                for name in conflict:
-                    if name in packages_scope:
-                        degree += 1
-            if degree > 1:
-                scope_conflicts[conflict] = conflicts[conflict]
-        if len(scope_conflicts) > 0:
-            for conflict in scope_conflicts:
-                logging.error("Conflict between {0} is "
-                              "critical.".format(", ".join(conflict)))
-            # FIXME: Here the script must fail, but it was disabled due to the
-            # fact that Tizen 2.4 images can be built with MIC even when some
-            # such conflicts exist.
-
-    def __build_dependency_graph(self, yum_base, packages_list = None):
+                logging.debug(message)
+            for path in conflict["files"]:
+                logging.debug(" * {0}".format(path))
+        critical_number = len([conflict for conflict in report
+                               if conflict["critical"]])
+        if len(report) > 0:
+            logging.warning("Found file conflicts between {0} groups of "
+                            "packages, {1} of them are critical".format(
+                                len(report), critical_number))
+        # FIXME: Here the script must fail if there are critical conflicts,
+        # but it was disabled due to the fact that Tizen 2.4 images can be
+        # built with MIC even when some such conflicts exist.
+        return report
+
+    def __build_dependency_graph(self, metadata, providers,
+                                 packages_list = None):
         """
         Builds the dependency graph of the repository.
 
-        @param yum_base         The YUM base.
-        @return                 Forward and backward dependency graphs.
+        @param metadata         The repository metadata.
+        @param providers        The dictionary that maps already resolved
+                                requirements to names of their providers.
+        @return                 The dependency graph.
         """
-        graph, back_graph = self.__build_dependency_graph_vertices(yum_base)
-        hidden_subprocess.function_call_monitor(
-            self.__build_dependency_graph_edges, (yum_base, graph, back_graph,
-                                                  packages_list),
-            dependency_graph_building_status)
-        return graph, back_graph
+        packages_scope_initial = self.packages
+        packages = self.__select_packages(metadata)
+        packages_scope, edges, provided_symbols, unprovided_symbols, \
+            providers = hidden_subprocess.function_call_monitor(
+                self.__build_dependency_graph_edges,
+                (metadata, packages, providers, packages_list),
+                dependency_graph_building_status)
+        global lazy_mode_enabled
+        if lazy_mode_enabled:
+            packages = [package for package in packages
+                        if package.name in packages_scope]
+            logging.info("{0} packages of {1} are reachable from the package "
+                         "scope".format(len(packages), self.repository_path))
+        graph = self.__build_dependency_graph_vertices(packages)
+        # Dependencies on packages without vertices (e. g. ones that have not
+        # passed the name check) are not represented in the graph:
+        graph.add_edges([(graph.get_name_id(begin), graph.get_name_id(end))
+                         for begin, end in edges
+                         if graph.get_name_id(end) is not None])
+        graph.provided_symbols = provided_symbols
+        graph.unprovided_symbols = unprovided_symbols
+        graph.resolved_requirements = providers
+        # The primary data lists only some files of packages, so conflicts
+        # cannot be detected without the complete file lists:
+        if (lazy_mode_enabled and packages_scope_initial is not None and
+                not metadata.file_lists_read):
+            logging.warning("File conflicts are not checked in {0}, because "
+                            "its file lists are not read in lazy "
+                            "mode".format(self.repository_path))
+            packages_scope_initial = None
+        symbol_providers, report = hidden_subprocess.function_call(
+            "Inspecting file conflicts",
+            self.__collect_symbol_providers, metadata.get_packages(),
+            packages_scope_initial)
+        graph.symbol_providers = symbol_providers
+        graph.file_conflicts = report
+        return graph
@@ -20,23 +20,42 @@
 
 import os
 import sys
-import re
+import errno
 import logging
 import urllib2
+import httplib
+import Queue
 import time
-from threading import Lock
-from urlparse import urlparse
+import socket
+from threading import Lock, Thread
+from contextlib import contextmanager
+from urlparse import urlparse, urljoin
 from HTMLParser import HTMLParser
 from rpmUtils.miscutils import splitFilename
 import files
-import hidden_subprocess
-import socket
+import repodata
+
 
+"""The number of files that are downloaded simultaneously."""
+jobs_number = 1
+"""The maximal number of index pages that are crawled simultaneously."""
+crawling_jobs_number = 4
+"""The timeout (in seconds) of socket operations."""
+timeout = 60
+"""The number of attempts to perform the request before giving up."""
+attempts_number = 5
+"""The maximal number of HTTP redirections that are followed."""
+redirections_number = 5
+"""The size of chunks in which files are read from the network."""
+buffer_size = 65536
+"""
+The name of the file in the local copy of the repository that lists files
+whose checksums have been verified.
+"""
+verified_list_name = ".verified"
 
-common_authenticator = None
-sizes = {}
-names = []
-sizes_lock = Lock()
+"""The downloaders that are currently running (used for status reporting)."""
+current_downloaders = []
 
 
 def resolve_link(link, url):
@@ -90,232 +109,904 @@ class LinkListingHTMLParser(HTMLParser):
                         continue
                     if value == "..":
                         continue
-                    value = resolve_link(value, self.__url)
-                    self.links.add(value)
+                    link = resolve_link(value, self.__url)
+                    # Links to files are not resolved with the trailing
+                    # slash, because servers do not serve files by such URLs:
+                    if not value.endswith("/"):
+                        link = link.rstrip("/")
+                    self.links.add(link)
                     break
 
 
-def urlopen(url):
+class ConnectionPool(object):
     """
-    Open the given URL.
+    The pool of keep-alive HTTP connections. Connections are kept per host
+    and are reused by subsequent requests to the same host, so that the
+    TCP (and TLS) handshake is not repeated for every file.
+    """
+    def __init__(self, authenticator=None):
+        """
+        Initializes the connection pool (does nothing).
+
+        @param authenticator    The encoded user:password string for download
+                                server.
+        """
+        self._authenticator = authenticator
+        self._connections = {}
+        self._lock = Lock()
+
+    def __acquire(self, scheme, netloc):
+        """
+        Takes the idle connection to the given host from the pool or creates
+        the new one.
+
+        @param scheme   The URL scheme.
+        @param netloc   The network location of the host.
+        @return         The connection.
+        """
+        with self._lock:
+            idle_connections = self._connections.get((scheme, netloc))
+            if idle_connections:
+                return idle_connections.pop()
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=timeout)
+        elif scheme == "http":
+            return httplib.HTTPConnection(netloc, timeout=timeout)
+        else:
+            raise Exception("URL scheme {0} is not supported!".format(scheme))
+
+    def __release(self, scheme, netloc, connection):
+        """
+        Returns the connection to the pool so that it can be reused.
+
+        @param scheme       The URL scheme.
+        @param netloc       The network location of the host.
+        @param connection   The connection.
+        """
+        with self._lock:
+            if (scheme, netloc) not in self._connections:
+                self._connections[(scheme, netloc)] = []
+            self._connections[(scheme, netloc)].append(connection)
 
-    @param url  The URL.
-    @return     Opened URL.
+    def __request(self, url, headers):
+        """
+        Sends the GET request for the given URL, retrying it on network
+        errors.
+
+        @param url          The URL.
+        @param headers      The additional headers of the request.
+        @return             The tuple (scheme, netloc, connection, response).
+        """
+        parsed_url = urlparse(url)
+        path = parsed_url.path
+        if len(path) == 0:
+            path = "/"
+        if len(parsed_url.query) > 0:
+            path = path + "?" + parsed_url.query
+        request_headers = {}
+        if self._authenticator is not None:
+            request_headers["Authorization"] = "Basic {0}".format(
+                self._authenticator)
+        if headers is not None:
+            request_headers.update(headers)
+
+        for attempt in range(1, attempts_number + 1):
+            connection = self.__acquire(parsed_url.scheme, parsed_url.netloc)
+            try:
+                connection.request("GET", path, headers=request_headers)
+                response = connection.getresponse()
+            except (httplib.HTTPException, socket.error) as error:
+                # Kept-alive connections can be closed by the server at any
+                # moment, so the request is repeated on the fresh one.
+                connection.close()
+                logging.debug("Attempt #{0} to open {1} failed: "
+                              "{2}".format(attempt, url, error))
+                if attempt == attempts_number:
+                    raise
+                time.sleep(0.1 * attempt)
+            else:
+                return (parsed_url.scheme, parsed_url.netloc, connection,
+                        response)
+
+    @contextmanager
+    def open(self, url, headers=None):
+        """
+        Opens the given URL following redirections. The connection is
+        returned to the pool when the response body has been completely read,
+        and is closed otherwise.
+
+        @param url          The URL.
+        @param headers      The additional headers of the request.
+        @return             The response.
+        """
+        logging.debug("Opening {0}".format(url))
+        for redirection in range(redirections_number + 1):
+            scheme, netloc, connection, response = self.__request(url,
+                                                                  headers)
+            if response.status not in [301, 302, 303, 307, 308]:
+                break
+            location = response.getheader("Location")
+            # Bodies of redirections are not always delimited, so the
+            # connection is not reused:
+            connection.close()
+            if location is None:
+                break
+            logging.debug("Redirected from {0} to {1}".format(url, location))
+            url = urljoin(url, location)
+
+        if response.status >= 400:
+            response.read()
+            self.__release(scheme, netloc, connection)
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, None)
+        try:
+            yield response
+        except:
+            connection.close()
+            raise
+        if response.isclosed():
+            self.__release(scheme, netloc, connection)
+        else:
+            connection.close()
+
+    def close(self):
+        """
+        Closes all idle connections of the pool.
+        """
+        with self._lock:
+            for connections in self._connections.values():
+                for connection in connections:
+                    connection.close()
+            self._connections = {}
+
+
+def download_file(response, file_path, append=False):
     """
-    logging.debug("\nOpening {0}\n".format(url))
-    response = None
-    global common_authenticator
-    if common_authenticator is not None:
-        request = urllib2.Request(url)
-        request.add_header("Authorization",
-                           "Basic {0}".format(common_authenticator))
-        response = urllib2.urlopen(request, timeout=60)
+    Downloads the given opened response to the given file path.
+
+    @param response     The response of the opened file URL.
+    @param file_path    The path.
+    @param append       Whether the response continues the already
+                        downloaded part of the file.
+    """
+    if append:
+        mode = 'ab'
     else:
-        response = urllib2.urlopen(url, timeout=60)
-    logging.debug("\nOpening {0} -> done\n".format(url))
-    return response
+        mode = 'wb'
+    with open(file_path, mode) as file_target:
+        chunk = response.read(buffer_size)
+        while chunk:
+            file_target.write(chunk)
+            chunk = response.read(buffer_size)
 
 
-def inspect_directory(url, target, check_url, packages_list = None):
+def _get_total_size(response, offset):
     """
-    Inspects the given remote directory to the local directory with the
-    given path.
+    Gets the total size of the remote file from the response headers.
 
-    @param url          The url of the remote HTTP directory.
-    @param target       The destination directory path.
-    @param check_url    The function that checks whether the file with given
-                        URL should be downloaded.
+    @param response     The response of the opened file URL.
+    @param offset       The offset from which the file was requested.
+    @return             The size of the file or None if it is unknown.
     """
-    global names
-    global sizes
-    logging.debug("=======Downloading {0} to {1}\n".format(url, target))
+    if response.status == 206:
+        content_range = response.getheader("Content-Range")
+        if content_range is not None and "/" in content_range:
+            total = content_range.rsplit("/", 1)[1].strip()
+            if total.isdigit():
+                return int(total)
+        return None
+    content_length = response.getheader("Content-Length")
+    if content_length is None:
+        return None
+    return int(content_length) + offset
 
-    def mkdir():
-        if not mkdir.done:
-            try:
-                os.mkdir(target)
-            except OSError:
-                pass
-            mkdir.done = True
-    mkdir.done = False
 
-    while True:
-        try:
-            response = urlopen(url)
-        except urllib2.HTTPError as error:
-            if error.code == 403:
-                logging.info("HTTP error 403 Forbidden for URL: "
-                             "{0}".format(url))
-                logging.debug("names: {0}".format(names))
-                removed_name = url.rsplit('/', 1)[1]
-                logging.debug("removed_name = {0}".format(removed_name))
-                if removed_name in names:
-                    names.remove(removed_name)
-                return
-        except urllib2.URLError as error:
-            logging.debug("Exception happened: (errno {0}) "
-                          "{1} while trying url {2}".format(
-                              error.errno, error, url))
-            time.sleep(0.1)
-        except socket.timeout as error:
-            logging.error("Connection timed out while trying to open url: " + url)
-            sys.exit("Error.")
-        else:
-            break
-    if response.info().type == 'text/html':
-        with sizes_lock:
-            if target in sizes.keys():
-                del sizes[target]
-        name = os.path.basename(target)
-        if name in names:
-            names.remove(os.path.basename(target))
-
-        contents = response.read()
+def verify_file(path, size=None, checksum_type=None, checksum=None):
+    """
+    Verifies that the file has the expected size and checksum.
+
+    @param path             The path to the file.
+    @param size             The expected size (or None if it is unknown).
+    @param checksum_type    The type of checksum (e. g. "sha256").
+    @param checksum         The expected checksum (or None if it is
+                            unknown).
+    @return                 True if the file is correct, False otherwise.
+    """
+    if not os.path.isfile(path):
+        return False
+    size_actual = os.path.getsize(path)
+    if size is None:
+        if size_actual == 0:
+            return False
+    elif size_actual != size:
+        return False
+    if checksum is not None:
+        checksum_actual = files.compute_checksum(path, checksum_type)
+        if checksum_actual != checksum:
+            logging.error("File {0} has {1} checksum {2} while it must be "
+                          "{3}".format(path, checksum_type, checksum_actual,
+                                       checksum))
+            return False
+    return True
+
+
+def _join_location(target, location):
+    """
+    Builds the local path of the file with the given repodata location.
+
+    @param target       The path to the local repository.
+    @param location     The location of the file relative to the repository
+                        root.
+    @return             The local path.
+    """
+    path = os.path.normpath(os.path.join(target, location))
+    if not path.startswith(os.path.normpath(target) + os.sep):
+        raise Exception("Location {0} points outside the "
+                        "repository!".format(location))
+    return path
+
+
+def _read_verified_list(target):
+    """
+    Reads the list of files of the local copy whose checksums have been
+    verified during the previous update.
+
+    @param target       The path to the local copy of the repository.
+    @return             The dictionary that maps locations of files to their
+                        verified checksums.
+    """
+    verified = {}
+    path = os.path.join(target, verified_list_name)
+    if not os.path.isfile(path):
+        return verified
+    with open(path, "r") as verified_list:
+        for line in verified_list:
+            parts = line.rstrip("\n").split(" ", 1)
+            if len(parts) == 2:
+                verified[parts[1]] = parts[0]
+    return verified
+
+
+def _write_verified_list(target, verified):
+    """
+    Writes the list of files of the local copy whose checksums have been
+    verified.
+
+    @param target       The path to the local copy of the repository.
+    @param verified     The dictionary that maps locations of files to their
+                        verified checksums.
+    """
+    path = os.path.join(target, verified_list_name)
+    path_temporary = path + ".part"
+    with open(path_temporary, "w") as verified_list:
+        for location in sorted(verified.keys()):
+            verified_list.write("{0} {1}\n".format(verified[location],
+                                                   location))
+    os.rename(path_temporary, path)
+
+
+class DirectoryDownloader(object):
+    """
+    Downloads the remote HTTP directory with the pool of worker threads.
+    Index pages are crawled and files are fetched by separate groups of
+    workers, so that the crawling is never blocked by large files.
+    """
+    def __init__(self, check_url, authenticator, packages_list=None,
+                 package_store=None):
+        """
+        Initializes the directory downloader.
+
+        @param check_url        The function that checks whether the file
+                                with given URL should be downloaded.
+        @param authenticator    The encoded user:password string for download
+                                server.
+        @param packages_list    The list of package names to be downloaded.
+        @param package_store    The storage of already downloaded files.
+        """
+        self._check_url = check_url
+        self._packages_list = packages_list
+        self._package_store = package_store
+        self._pool = ConnectionPool(authenticator)
+        self._pages = Queue.Queue()
+        self._files = Queue.Queue()
+        self._workers = []
+        self._lock = Lock()
+        self._errors = []
+        self._verified = {}
+        self.files_number_total = 0
+        self.files_number_done = 0
+        self.name_last_processed = "unknown"
+
+    def __select_links(self, url, contents):
+        """
+        Selects links from the index page that should be downloaded.
+
+        @param url          The URL of the index page.
+        @param contents     The HTML contents of the page.
+        @return             The list of selected absolute links.
+        """
         parser = LinkListingHTMLParser(url)
         parser.feed(contents)
         links_resolved = []
+        links_rpm = []
         logging.debug("Links:\n")
         for link in parser.links:
-            link = resolve_link(link, url)
-            if link[-1] == '/':
-                link = link[:-1]
-            if not link.startswith(url):
+            # Links to directories keep their trailing slash, so that they
+            # are requested without redirection:
+            path = link.rstrip('/')
+            if not path.startswith(url) or path == url.rstrip('/'):
                 continue
-            if not check_url(link):
+            if not self._check_url(path):
                 continue
-            name = link.rsplit('/', 1)[1]
-            if '?' in name:
+            name = path.rsplit('/', 1)[1]
+            if '?' in name or name in ['.', '..']:
                 continue
             if name.endswith('.rpm'):
-                if packages_list is not None:
+                link = path
+                if self._packages_list is not None:
                     base_name = splitFilename(os.path.basename(name))
-                    if base_name:
-                        rpm_name = base_name[0]
-                        if rpm_name in packages_list:
-                            links_resolved.append(link)
-                            logging.debug(" * {0}\n".format(link))
-                            names.append(name)
-                else:
-                    links_resolved.append(link)
-                    names.append(name)
+                    if not base_name or base_name[0] not in self._packages_list:
+                        continue
+                links_rpm.append(link)
+                continue
+            links_resolved.append(link)
+            logging.debug(" * {0}\n".format(link))
+        # Older versions of packages are not downloaded at all:
+        links_rpm, _ = repodata.select_newest(links_rpm,
+                                              repodata.get_file_nevra)
+        for link in links_rpm:
+            links_resolved.append(link)
+            logging.debug(" * {0}\n".format(link))
+        return links_resolved
+
+    def __add_file(self, url, target, size=None, checksum_type=None,
+                   checksum=None, trusted=False):
+        """
+        Schedules the download of the file.
+
+        @param url              The URL of the file.
+        @param target           The destination file path.
+        @param size             The expected size of the file.
+        @param checksum_type    The type of checksum of the file.
+        @param checksum         The expected checksum of the file.
+        @param trusted          Whether the checksum of the already present
+                                file has been verified earlier.
+        """
+        with self._lock:
+            self.files_number_total += 1
+        self._files.put((url, target, size, checksum_type, checksum,
+                         trusted))
+
+    def __complete_file(self, target):
+        """
+        Marks the file as completely downloaded.
+
+        @param target   The destination file path.
+        """
+        with self._lock:
+            self.files_number_done += 1
+            self.name_last_processed = os.path.basename(target)
+
+    def __inspect_page(self, url, target):
+        """
+        Inspects the given remote directory page and schedules the download
+        of its contents to the local directory with the given path.
+
+        @param url          The URL of the remote page.
+        @param target       The destination directory path.
+        """
+        logging.debug("=======Inspecting {0} to {1}\n".format(url, target))
+        try:
+            with self._pool.open(url) as response:
+                content_type = response.getheader("Content-Type", "")
+                if not content_type.startswith("text/html"):
+                    # This is not a directory listing but a simple file, it
+                    # is downloaded by file workers:
+                    self.__add_file(url, target)
+                    return
+                contents = response.read()
+        except urllib2.HTTPError as error:
+            if error.code == 403:
+                logging.info("HTTP error 403 Forbidden for URL: "
+                             "{0}".format(url))
+                return
+            raise
+
+        links = self.__select_links(url, contents)
+        if len(links) == 0:
+            return
+        try:
+            os.makedirs(target)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        for link in links:
+            name = link.rstrip('/').rsplit('/', 1)[1]
+            link_target = os.path.join(target, name)
+            if name.endswith('.rpm'):
+                self.__add_file(link, link_target)
             else:
-                links_resolved.append(link)
-                logging.debug(" * {0}\n".format(link))
-        for link in links_resolved:
-            mkdir()
-            name = link.rsplit('/', 1)[1]
-            inspect_directory(link, os.path.join(target, name), check_url, packages_list)
-            if not mkdir.done:
-                # We didn't find anything to write inside this directory
-                # Maybe it's a HTML file?
-                if os.path.isdir(target):
-                    continue
-                if url[-1] != '/':
-                    end = target[-5:].lower()
-                    if not (end.endswith('.htm') or end.endswith('.html')):
-                        target = target + '.html'
-                    if not (os.path.isfile(target) and
-                            os.path.getsize(target) > 0):
-                        logging.debug("Simple download {0}\n".format(target))
-                        with open(target, 'wb') as file_target:
-                            file_target.write(contents)
-    else:
-        with sizes_lock:
-            sizes[target] = response.info().getheaders("Content-Length")[0]
-            logging.debug(
-                "Setting size of {0} to {1}\n".format(target, sizes[target]))
-            download_file(response, target)
+                self._pages.put((link, link_target))
 
+    def __store_file(self, target, checksum_type, checksum):
+        """
+        Puts the verified file to the package store and marks it as
+        completely downloaded.
 
-def download_file(response, file_path):
-    """
-    Downloads the given file URL to the given file path.
+        @param target           The destination file path.
+        @param checksum_type    The type of checksum of the file.
+        @param checksum         The checksum of the file.
+        """
+        if self._package_store is not None and checksum is not None:
+            self._package_store.add(target, checksum_type, checksum)
+        self.__mark_verified(target, checksum)
+        self.__complete_file(target)
 
-    @param response     The urlopen response of file opening.
-    @param file_path    The path.
-    """
-    # Do not repeat the download if file already presents.
-    if (os.path.isfile(file_path) and
-            os.path.getsize(file_path) > 0):
-        return
-    num_attempts = 0
-    while True:
-        buffer_size = 4096
-        with open(file_path, 'wb') as file_target:
-            chunk = response.read(buffer_size)
-            while chunk:
-                file_target.write(chunk)
-                chunk = response.read(buffer_size)
-        size = os.stat(file_path).st_size
-        global sizes
-        if sizes.get(file_path) is None:
-            raise Exception("File {0} is not correct.".format(file_path))
-        if int(size) == int(sizes[file_path]):
-            break
-        else:
-            logging.error("File has size {0} while it must be "
-                          "{1}".format(size, sizes[file_path]))
-            logging.error("Attempt #{0} to download remote file {1} failed, "
-                          "retrying...".format(num_attempts, file_path))
-            num_attempts += 1
-            time.sleep(1)
+    def __mark_verified(self, target, checksum):
+        """
+        Remembers that the file has the given checksum, so that it is not
+        hashed again during the next update of the local copy.
+
+        @param target           The destination file path.
+        @param checksum         The verified checksum of the file (or None
+                                if it is unknown).
+        """
+        if checksum is None:
+            return
+        with self._lock:
+            self._verified[target] = checksum
+
+    def __fetch_file(self, url, target, size, checksum_type, checksum,
+                     trusted):
+        """
+        Downloads the remote file to the given path. The file is downloaded
+        to the temporary name and is continued with HTTP Range requests after
+        network failures. It is renamed to the target path only after it has
+        been verified.
+
+        @param url              The URL of the remote file.
+        @param target           The destination file path.
+        @param size             The expected size of the file.
+        @param checksum_type    The type of checksum of the file.
+        @param checksum         The expected checksum of the file.
+        @param trusted          Whether the checksum of the already present
+                                file has been verified earlier.
+        """
+        # Do not repeat the download if the correct file already presents.
+        if os.path.isfile(target):
+            if trusted:
+                correct = verify_file(target, size)
+            else:
+                correct = verify_file(target, size, checksum_type, checksum)
+            if correct:
+                self.__store_file(target, checksum_type, checksum)
+                return
+            logging.warning("File {0} is corrupted and will be downloaded "
+                            "again.".format(target))
+            os.remove(target)
+        directory = os.path.dirname(target)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        # The file can be already downloaded for another repository:
+        if (self._package_store is not None and checksum is not None and
+                self._package_store.fetch(checksum_type, checksum, target)):
+            if verify_file(target, size):
+                logging.debug("File {0} is taken from the package "
+                              "store".format(target))
+                self.__mark_verified(target, checksum)
+                self.__complete_file(target)
+                return
+            os.remove(target)
+        part_path = target + ".part"
+        attempt = 0
+        while True:
+            offset = 0
+            if os.path.isfile(part_path):
+                offset = os.path.getsize(part_path)
+            if size is not None and offset > size:
+                os.remove(part_path)
+                offset = 0
+            # Without the known size the file is complete only if the
+            # server has closed the response cleanly:
+            complete = False
+            try:
+                if size is None or offset < size:
+                    headers = None
+                    if offset > 0:
+                        logging.debug("Continuing download of {0} from byte "
+                                      "{1}".format(url, offset))
+                        headers = {"Range": "bytes={0}-".format(offset)}
+                    with self._pool.open(url, headers) as response:
+                        if response.status != 206:
+                            # The server does not support ranges, so the
+                            # whole file is sent again:
+                            offset = 0
+                        if size is None:
+                            size = _get_total_size(response, offset)
+                        download_file(response, part_path, offset > 0)
+                complete = True
+            except urllib2.HTTPError as error:
+                if error.code == 403:
+                    logging.info("HTTP error 403 Forbidden for URL: "
+                                 "{0}".format(url))
+                    with self._lock:
+                        self.files_number_total -= 1
+                    return
+                elif error.code == 416:
+                    os.remove(part_path)
+                else:
+                    raise
+            except (httplib.HTTPException, socket.error) as error:
+                logging.warning("Download of {0} was interrupted: "
+                                "{1}".format(url, error))
+
+            if ((size is not None or complete) and
+                    verify_file(part_path, size, checksum_type, checksum)):
+                os.rename(part_path, target)
+                self.__store_file(target, checksum_type, checksum)
+                return
+            offset_new = 0
+            if os.path.isfile(part_path):
+                offset_new = os.path.getsize(part_path)
+                if ((size is None and complete) or
+                        (size is not None and offset_new >= size)):
+                    # The file is complete, but it is corrupted:
+                    os.remove(part_path)
+                    offset_new = 0
+            # Attempts that have made progress are not counted, so that
+            # large files can be downloaded over unstable connections:
+            if offset_new <= offset:
+                attempt += 1
+                if attempt >= attempts_number:
+                    raise Exception("Failed to download {0}!".format(url))
+                logging.error("Attempt #{0} to download remote file {1} "
+                              "failed, retrying...".format(attempt, url))
+                time.sleep(1)
+
+    def __work(self, queue, handler):
+        """
+        The loop of the worker thread.
+
+        @param queue    The queue of tasks.
+        @param handler  The function that processes the task.
+        """
+        while True:
+            task = queue.get()
+            if task is None:
+                queue.task_done()
+                return
+            try:
+                if len(self._errors) == 0:
+                    handler(*task)
+            except Exception as error:
+                logging.error("Failed to download {0}: "
+                              "{1}".format(task[0], error))
+                with self._lock:
+                    self._errors.append(error)
+            finally:
+                queue.task_done()
+
+    def __start_workers(self, queue, handler, workers_number):
+        """
+        Starts the given number of worker threads on the queue.
+
+        @param queue            The queue of tasks.
+        @param handler          The function that processes the task.
+        @param workers_number   The number of workers.
+        """
+        for i in range(workers_number):
+            worker = Thread(target=self.__work, args=(queue, handler))
+            worker.daemon = True
+            worker.start()
+            self._workers.append((queue, worker))
+
+    def __start(self):
+        """
+        Starts crawling and downloading workers.
+        """
+        width = max(1, jobs_number)
+        logging.debug("Starting {0} downloading workers".format(width))
+        self.__start_workers(self._pages, self.__inspect_page,
+                             min(width, crawling_jobs_number))
+        self.__start_workers(self._files, self.__fetch_file, width)
+
+    def __wait(self, url):
+        """
+        Waits until all scheduled pages and files are processed.
+
+        @param url      The URL of the downloaded directory.
+        """
+        # All files are scheduled only after all pages have been inspected:
+        self._pages.join()
+        self._files.join()
+        if len(self._errors) > 0:
+            self.__stop()
+            logging.error("Failed to download directory {0}!".format(url))
+            sys.exit("Error.")
+
+    def __stop(self):
+        """
+        Stops all workers and closes connections.
+        """
+        for queue, worker in self._workers:
+            queue.put(None)
+        for queue, worker in self._workers:
+            worker.join()
+        self._workers = []
+        self._pool.close()
+
+    def crawl(self, url, target):
+        """
+        Downloads the given remote directory to the local directory with the
+        given path crawling its HTML index pages.
+
+        @param url          The URL of the remote HTTP directory.
+        @param target       The destination directory path.
+        """
+        self.__start()
+        self._pages.put((url, target))
+        self.__wait(url)
+        self.__stop()
+
+    def __read_repomd(self, url):
+        """
+        Reads repomd.xml file of the remote repository.
+
+        @param url      The URL of the remote repository.
+        @return         The content of repomd.xml, or None if the repository
+                        does not publish it.
+        """
+        repomd_url = url + "repodata/repomd.xml"
+        try:
+            with self._pool.open(repomd_url) as response:
+                return response.read()
+        except urllib2.HTTPError as error:
+            if error.code in [403, 404]:
+                logging.info("No repodata is published at {0} (HTTP error "
+                             "{1})".format(url, error.code))
+                return None
+            raise
+
+    def __check_package(self, url, package):
+        """
+        Checks whether the package should be downloaded.
+
+        @param url      The URL of the remote repository.
+        @param package  The package record from repodata.
+        @return         True if the package should be downloaded.
+        """
+        if (self._packages_list is not None and
+                package.name not in self._packages_list):
+            return False
+        return self._check_url(url + package.location)
+
+    def __read_snapshot(self, target):
+        """
+        Reads the repodata of the local copy that has been downloaded
+        previously.
+
+        @param target   The path to the local copy of the repository.
+        @return         The pair of dictionaries that map locations of
+                        repodata files and of packages to their checksums.
+        """
+        records = {}
+        packages = {}
+        repomd_path = os.path.join(target, "repodata", "repomd.xml")
+        if not os.path.isfile(repomd_path):
+            return records, packages
+        with open(repomd_path, "rb") as repomd:
+            repomd_content = repomd.read()
+        try:
+            records_parsed = repodata.parse_repomd(repomd_content)
+            for record in records_parsed.values():
+                records[record["location"]] = record["checksum"]
+            primary_path = None
+            if "primary" in records_parsed:
+                primary_path = _join_location(
+                    target, records_parsed["primary"]["location"])
+            if primary_path is not None and os.path.isfile(primary_path):
+                with repodata.open_data(primary_path) as primary:
+                    for package in repodata.read_packages(primary):
+                        packages[package.location] = package.checksum
+        except Exception as error:
+            logging.warning("Failed to read the cached repodata in {0}: "
+                            "{1}".format(target, error))
+            return {}, {}
+        return records, packages
+
+    def __add_known_file(self, url, target, location, size, checksum_type,
+                         checksum, checksums_known):
+        """
+        Adds the file to the download queue. If the checksum of the file in
+        the local copy has already been verified, only its size is checked,
+        so that unchanged files are not hashed again.
+
+        @param url              The URL of the remote repository.
+        @param target           The destination directory path.
+        @param location         The location of file in the repository.
+        @param size             The expected size of the file.
+        @param checksum_type    The type of checksum of the file.
+        @param checksum         The expected checksum of the file.
+        @param checksums_known  The dictionary that maps locations of files
+                                in the local copy to their verified
+                                checksums.
+        """
+        trusted = (checksum is not None and
+                   checksums_known.get(location) == checksum)
+        self.__add_file(url + location, _join_location(target, location),
+                        size, checksum_type, checksum, trusted)
+
+    def fetch_repository(self, url, target):
+        """
+        Downloads the given remote repository to the local directory with the
+        given path using its repodata. Only repodata files and RPMs listed in
+        primary.xml are downloaded, so no index pages are crawled.
+
+        If the directory already contains the previously downloaded copy of
+        the repository, it is updated incrementally: only added and changed
+        packages are downloaded, and packages that have disappeared from the
+        repository are removed.
+
+        @param url          The URL of the remote repository.
+        @param target       The destination directory path.
+        @return             The list of downloaded package records, or None
+                            if the repository does not publish repodata.
+        """
+        repomd_content = self.__read_repomd(url)
+        if repomd_content is None:
+            return None
+        records = repodata.parse_repomd(repomd_content)
+        if "primary" not in records:
+            logging.warning("Repodata at {0} does not describe primary "
+                            "data!".format(url))
+            return None
+        records_known, packages_known = self.__read_snapshot(target)
+        # The list is removed until the update is finished, because files can
+        # be replaced by the interrupted update:
+        verified_known = _read_verified_list(target)
+        files.safe_remove(os.path.join(target, verified_list_name))
+        if len(packages_known) > 0:
+            logging.info("Updating the local copy of {0} with {1} "
+                         "packages".format(url, len(packages_known)))
+
+        self.__start()
+        for record in records.values():
+            self.__add_known_file(url, target, record["location"],
+                                  record["size"], record["checksum_type"],
+                                  record["checksum"], verified_known)
+        self.__wait(url)
+
+        primary_path = _join_location(target, records["primary"]["location"])
+        with repodata.open_data(primary_path) as primary:
+            packages = [package for package in repodata.read_packages(primary)
+                        if self.__check_package(url, package)]
+        # Older versions of packages are not downloaded at all:
+        packages, packages_dropped = repodata.select_newest(packages)
+        if len(packages_dropped) > 0:
+            logging.info("{0} outdated packages from {1} will not be "
+                         "downloaded".format(len(packages_dropped), url))
+        packages_changed_number = 0
+        for package in packages:
+            if packages_known.get(package.location) != package.checksum:
+                packages_changed_number += 1
+            self.__add_known_file(url, target, package.location,
+                                  package.size, package.checksum_type,
+                                  package.checksum, verified_known)
+        logging.info("{0} packages from {1} will be downloaded, {2} of them "
+                     "are new or changed".format(len(packages), url,
+                                                 packages_changed_number))
+        self.__wait(url)
+        self.__stop()
+
+        locations_used = set(package.location for package in packages)
+        locations_used.update(record["location"]
+                              for record in records.values())
+
+        # The repomd.xml is written the last, so the repodata becomes visible
+        # only when it is complete:
+        repomd_path = os.path.join(target, "repodata", "repomd.xml")
+        with open(repomd_path, "wb") as repomd:
+            repomd.write(repomd_content)
+
+        verified = {}
+        for location in locations_used:
+            checksum = self._verified.get(_join_location(target, location))
+            if checksum is not None:
+                verified[location] = checksum
+        _write_verified_list(target, verified)
+
+        # Files of the previous snapshot that are not used anymore:
+        locations_stale = set(packages_known.keys())
+        locations_stale.update(records_known.keys())
+        locations_stale.difference_update(locations_used)
+        for location in locations_stale:
+            path = _join_location(target, location)
+            if os.path.isfile(path):
+                logging.debug("Removing stale file {0}".format(path))
+                os.remove(path)
+        return packages
 
 
 def download_status_callback():
     """
-    Gets the status of downloading process.
+    Gets the status of downloading process. The status of all concurrently
+    running downloaders is summed up.
     """
-    paths = []
-    sizes_copy = {}
-    with sizes_lock:
-        global sizes
-        sizes_copy = sizes.copy()
-    global names
-    logging.debug("Length of sizes is {0}.\n".format(len(sizes)))
-    name_current = "unknown"
-    for path, size in sizes_copy.iteritems():
-        logging.debug("Analyzing {0} that must have size {1}.\n".format(path, size))
-        name = os.path.basename(path)
-        if os.path.isfile(path):
-            size_actual = os.stat(path).st_size
-            if (int(size) > 0 and int(size_actual) == int(size) and name in names):
-                name_current = name
-                paths.append(path)
-                logging.debug("   collected!\n")
-            elif int(size_actual) != int(size):
-                logging.debug("   Size of {0} is {1} while must be {2}.\n".format(
-                    path, size_actual, size))
-        else:
-            logging.debug("   not a file.\n")
-    logging.debug("--- Found {0} collected ---\n".format(len(paths)))
-    if len(names) > 0:
-        num_tasks = len(names)
-    else:
-        num_tasks = 1
-    num_tasks_done = len(paths)
-    return ("Downloading", name_current, num_tasks_done, num_tasks)
+    downloaders = list(current_downloaders)
+    if len(downloaders) == 0:
+        return ("Downloading", "unknown", 0, 1)
+    num_tasks = 0
+    num_tasks_done = 0
+    for downloader in downloaders:
+        num_tasks_current = max(1, downloader.files_number_total)
+        num_tasks += num_tasks_current
+        num_tasks_done += min(downloader.files_number_done, num_tasks_current)
+    return ("Downloading", downloaders[-1].name_last_processed,
+            num_tasks_done, num_tasks)
 
 
-def download_directory(url, target, check_url, authenticator, packages_list = None):
+def download_directory(url, target, check_url, authenticator,
+                       packages_list=None):
     """
     Inspects the given remote directory to the local directory with the
     given path.
 
+    The progress is not printed by this function, the caller is expected to
+    monitor it with download_status_callback.
+
     @param url              The url of the remote HTTP directory.
     @param target           The destination directory path.
     @param check_url        The function that checks whether the file with
                             given URL should be downloaded.
     @param authenticator    The encoded user:password string for download
                             server.
+    @param packages_list    The list of package names to be downloaded.
+    """
+    if not url.endswith("/"):
+        url = url + "/"
+    downloader = DirectoryDownloader(check_url, authenticator, packages_list)
+    current_downloaders.append(downloader)
+    try:
+        downloader.crawl(url, target)
+    finally:
+        current_downloaders.remove(downloader)
+
+
+def download_repository(url, target, check_url, authenticator,
+                        packages_list=None, package_store=None):
+    """
+    Downloads the given remote repository to the local directory with the
+    given path. The list of packages is taken from the repodata published by
+    the server, and if there is no repodata, the HTML index is crawled.
+
+    The progress is not printed by this function, the caller is expected to
+    monitor it with download_status_callback.
+
+    @param url              The url of the remote repository.
+    @param target           The destination directory path.
+    @param check_url        The function that checks whether the file with
+                            given URL should be downloaded.
+    @param authenticator    The encoded user:password string for download
+                            server.
+    @param packages_list    The list of package names to be downloaded.
+    @param package_store    The storage of already downloaded files.
+    @return                 The list of downloaded package records, or None
+                            if the repository was crawled.
     """
     if not url.endswith("/"):
         url = url + "/"
-    global common_authenticator
-    common_authenticator = authenticator
-    global sizes
-    sizes = {}
-    global names
-    names = []
-    hidden_subprocess.function_call_monitor(
-        inspect_directory, (url, target, check_url, packages_list),
-        download_status_callback)
+    downloader = DirectoryDownloader(check_url, authenticator, packages_list,
+                                     package_store)
+    current_downloaders.append(downloader)
+    try:
+        packages = downloader.fetch_repository(url, target)
+    finally:
+        current_downloaders.remove(downloader)
+    if packages is None:
+        logging.info("Falling back to crawling of {0}".format(url))
+        download_directory(url, target, check_url, authenticator,
+                           packages_list)
+    return packages
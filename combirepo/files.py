@@ -21,8 +21,11 @@
 import os
 import shutil
 import sys
+import errno
+import fcntl
 import logging
 import re
+import hashlib
 import check
 import hidden_subprocess
 import scandir
@@ -51,6 +54,40 @@ def find_fast(directory, expression):
     return files_found
 
 
+def get_directory_size(directory):
+    """
+    Computes the total size of files in the given directory.
+
+    @param directory    The directory.
+    @return             The size in bytes.
+    """
+    size = 0
+    for root, dirs, files in scandir.walk(directory):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+    return size
+
+
+def compute_checksum(path, checksum_type):
+    """
+    Computes the checksum of the given file.
+
+    @param path             The path to the file.
+    @param checksum_type    The type of checksum as it is named in repodata
+                            (e. g. "sha256", "sha" or "md5").
+    @return                 The hexadecimal digest of the file.
+    """
+    if checksum_type == "sha":
+        checksum_type = "sha1"
+    hasher = hashlib.new(checksum_type)
+    with open(path, "rb") as file_checked:
+        chunk = file_checked.read(1048576)
+        while chunk:
+            hasher.update(chunk)
+            chunk = file_checked.read(1048576)
+    return hasher.hexdigest()
+
+
 def create_symlink(package_name, location_from, directory_to):
     """
     Creates symlink from file to the file with the same name in the another
@@ -70,6 +107,92 @@ def create_symlink(package_name, location_from, directory_to):
     os.symlink(location_from, location_to)
 
 
+"""The request code of ioctl that clones the content of one file to another one
+on copy-on-write filesystems (FICLONE in linux/fs.h)."""
+_ficlone = 0x40049409
+
+
+"""Whether reflinks are not supported, it is set after the first failure, so
+that they are not tried for each file."""
+_reflinks_unsupported = False
+
+
+def _create_reflink(location_from, location_to):
+    """
+    Creates the copy-on-write clone of the file. The clone is created as the
+    new file, so the existing file is never truncated (it can be the hard
+    link to the original package).
+
+    @param location_from    The source file.
+    @param location_to      The clone to be created.
+    @return                 True if the clone has been created, False if it
+                            cannot be created for this file.
+    """
+    global _reflinks_unsupported
+    if _reflinks_unsupported:
+        return False
+    descriptor_to = os.open(location_to,
+                            os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    try:
+        with open(location_from, "rb") as file_from:
+            fcntl.ioctl(descriptor_to, _ficlone, file_from.fileno())
+        return True
+    except IOError as error:
+        logging.debug("Cannot clone {0}: {1}".format(location_from, error))
+        # Other errors (e. g. EXDEV for files on different filesystems) are
+        # specific to the file, so reflinks are tried for next files:
+        if error.errno in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL]:
+            _reflinks_unsupported = True
+    finally:
+        os.close(descriptor_to)
+    os.remove(location_to)
+    return False
+
+
+def place_file(location_from, directory_to):
+    """
+    Places the file to the file with the same name in the another directory
+    without copying its content when it is possible. The reflink is created
+    if the filesystem supports it, otherwise the hard link is created, and
+    the symlink is created if the directory is on another filesystem. The
+    file is copied only if links cannot be created at all. The existing
+    destination file is replaced, unless it is already the link to the
+    source file.
+
+    @param location_from    The source file.
+    @param directory_to     The destination directory.
+    """
+    check.file_exists(location_from)
+    location_to = os.path.join(directory_to,
+                               os.path.basename(location_from))
+    if os.path.lexists(location_to):
+        if (os.path.exists(location_to) and
+                os.path.samefile(location_from, location_to)):
+            return
+        # The existing file can be the hard link to another package, so it is
+        # removed instead of being overwritten:
+        logging.debug("Replacing existing file {0}".format(location_to))
+        os.remove(location_to)
+    if _create_reflink(location_from, location_to):
+        return
+    try:
+        os.link(location_from, location_to)
+        return
+    except OSError as error:
+        if error.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+        logging.debug("Cannot link {0}: {1}".format(location_from, error))
+    try:
+        os.symlink(os.path.abspath(location_from), location_to)
+        return
+    except OSError as error:
+        if error.errno not in [errno.EPERM, errno.EOPNOTSUPP]:
+            raise
+        logging.debug("Cannot create symlink to {0}: "
+                      "{1}".format(location_from, error))
+    shutil.copy(location_from, location_to)
+
+
 def unrpm(rpm_path, destination_path):
     """
     Unpacks the RPM package from the given location to the given directory.
@@ -99,3 +222,17 @@ def safe_rmtree(path):
     """
     if os.path.isdir(path):
         shutil.rmtree(path)
+
+
+def safe_remove(path):
+    """
+    Removes the file safely, i. e. does not raise exception in case when
+    the file does not exit.
+
+    @param path     The path to the file.
+    """
+    try:
+        os.remove(path)
+    except OSError as error:
+        if error.errno != errno.ENOENT:
+            raise
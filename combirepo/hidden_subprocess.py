@@ -24,6 +24,7 @@ import subprocess
 import multiprocessing
 import multiprocessing.pool
 import threading
+import atexit
 import logging
 import time
 import temporaries
@@ -287,14 +288,113 @@ def function_call_list(comment, function, tasks):
     @param tasks        The list of tuples (name, arguments) where name will
                         be printed in progress bar and arguments will be passed
                         to the funciton call.
+    @return             The list of return values of calls in the order of
+                        tasks.
     """
     tasks_copy = list(tasks)
     tasks_num = len(tasks_copy)
+    results = []
     for i_task, task in enumerate(tasks_copy, start=1):
         print_status(comment, task[0], i_task, tasks_num)
         arguments = task[1:]
-        function(*arguments)
+        results.append(function(*arguments))
     sys.stdout.write("\n")
+    return results
+
+
+def _hide_output():
+    """
+    Hides the output of the worker process, so that progress bars printed by
+    workers do not mix with the progress bar of the parent process.
+    """
+    sys.stdout = open(os.devnull, "w")
+
+
+def _run_exit_handlers(handlers_number):
+    """
+    Runs the exit handlers that have been registered after the given number
+    of handlers, in the reverse order of their registration.
+
+    @param handlers_number  The number of handlers that are kept.
+    """
+    while len(atexit._exithandlers) > handlers_number:
+        function, arguments, keywords = atexit._exithandlers.pop()
+        try:
+            function(*arguments, **keywords)
+        except Exception as error:
+            logging.warning("Exit handler {0} has failed: "
+                            "{1}".format(function.__name__, error))
+
+
+def _call_task(task):
+    """
+    Calls the function of the task in the worker process.
+
+    Worker processes never run exit handlers, so handlers registered by the
+    task (e. g. the removal of temporaries) are run as soon as it finishes.
+
+    @param task     The tuple (function, index, name, arguments).
+    @return         The tuple (index, name, return value of the function,
+                    error message or None if the task has succeeded).
+    """
+    function, index, name, arguments = task
+    handlers_number = len(atexit._exithandlers)
+    try:
+        result = function(*arguments)
+    except SystemExit as error:
+        # The pool waits forever for the task of the exited worker, so the
+        # exit is reported to the parent process:
+        return index, name, None, "{0}".format(error.code)
+    except Exception as error:
+        return index, name, None, "{0}".format(error)
+    finally:
+        _run_exit_handlers(handlers_number)
+    return index, name, result, None
+
+
+def function_call_list_parallel(comment, function, tasks, jobs_number):
+    """
+    Calls the function for each element of the task list in the pool of
+    worker processes. The function must be defined at the module level,
+    because it is passed to workers. If some task fails, the failure is
+    reported and the program exits.
+
+    @param comment      Comment about what is being done.
+    @param function     The function to be called.
+    @param tasks        The list of tuples (name, arguments) where name will
+                        be printed in progress bar and arguments will be passed
+                        to the funciton call.
+    @param jobs_number  The number of worker processes.
+    @return             The list of return values of calls in the order of
+                        tasks, they must be picklable.
+    """
+    tasks_copy = list(tasks)
+    tasks_num = len(tasks_copy)
+    if jobs_number <= 1 or tasks_num <= 1:
+        return function_call_list(comment, function, tasks_copy)
+    pool = multiprocessing.Pool(min(jobs_number, tasks_num), _hide_output)
+    results = [None] * tasks_num
+    try:
+        calls = [(function, index, task[0], task[1:]) for index, task
+                 in enumerate(tasks_copy)]
+        print_status(comment, "", 0, tasks_num)
+        for i_task, (index, name, result, error) in enumerate(
+                pool.imap_unordered(_call_task, calls), start=1):
+            if error is not None:
+                sys.stdout.write("\n")
+                logging.error("{0} {1} has failed: {2}".format(comment,
+                                                               name, error))
+                sys.exit("Error.")
+            results[index] = result
+            print_status(comment, name, i_task, tasks_num)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    sys.stdout.write("\n")
+    return results
 
 
 """The function that is called to get the status of the process."""
@@ -318,12 +418,14 @@ def function_call_monitor(function, arguments, status_callback):
     @param arguments        Its arguments to be passed to it.
     @param status_callback  The callback for getting the status of the
                             process.
+    @return                 The return value of the called function.
     """
     global global_status_callback
     global_status_callback = status_callback
     timer = RepeatingTimer(latency, print_status_dynamic)
     timer.daemon = True
     timer.start()
-    function(*arguments)
+    result = function(*arguments)
     timer.cancel()
     sys.stdout.write('\n')
+    return result
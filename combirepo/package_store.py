@@ -0,0 +1,147 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Copyright (C) Samsung Electronics, 2016
+#
+# 2016         Ilya Palachev                 <i.palachev@samsung.com>
+
+import os
+import errno
+import logging
+import scandir
+# Combirepo modules:
+import check
+
+
+class PackageStore(object):
+    """
+    The content-addressed storage of downloaded files. Each file is stored
+    once under the name of its checksum, and repositories refer to it with
+    hard links, so that files shared by several repositories and snapshots
+    occupy the disk space only once.
+    """
+    def __init__(self, path):
+        """
+        Initializes the storage.
+
+        @param path     The path to the storage directory. It must be located
+                        on the same file system as repositories.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        check.directory_exists(path)
+        self._path = path
+
+    @property
+    def path(self):
+        """The path to the storage directory."""
+        return self._path
+
+    def __get_blob_path(self, checksum_type, checksum):
+        """
+        Gets the path to the stored file with the given checksum.
+
+        @param checksum_type    The type of checksum (e. g. "sha256").
+        @param checksum         The checksum of the file.
+        @return                 The path to the stored file.
+        """
+        return os.path.join(self._path, checksum_type, checksum[:2], checksum)
+
+    def has(self, checksum_type, checksum):
+        """
+        Checks whether the file with the given checksum is stored.
+
+        @param checksum_type    The type of checksum (e. g. "sha256").
+        @param checksum         The checksum of the file.
+        @return                 True if the file is stored.
+        """
+        return os.path.isfile(self.__get_blob_path(checksum_type, checksum))
+
+    def fetch(self, checksum_type, checksum, path):
+        """
+        Places the stored file with the given checksum to the given path.
+
+        @param checksum_type    The type of checksum (e. g. "sha256").
+        @param checksum         The checksum of the file.
+        @param path             The destination path.
+        @return                 True if the file has been placed, False if it
+                                is not stored.
+        """
+        blob_path = self.__get_blob_path(checksum_type, checksum)
+        link_path = path + ".link"
+        try:
+            if os.path.lexists(link_path):
+                os.remove(link_path)
+            os.link(blob_path, link_path)
+        except OSError as error:
+            if error.errno == errno.ENOENT:
+                return False
+            raise
+        os.rename(link_path, path)
+        return True
+
+    def add(self, path, checksum_type, checksum):
+        """
+        Puts the verified file to the storage. If the file with the same
+        checksum is already stored, the given file is replaced by the link to
+        the stored one.
+
+        @param path             The path to the file.
+        @param checksum_type    The type of checksum (e. g. "sha256").
+        @param checksum         The checksum of the file.
+        """
+        blob_path = self.__get_blob_path(checksum_type, checksum)
+        directory = os.path.dirname(blob_path)
+        try:
+            os.makedirs(directory)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+        try:
+            os.link(path, blob_path)
+            return
+        except OSError as error:
+            if error.errno in [errno.EXDEV, errno.EPERM]:
+                logging.debug("Cannot store {0}: {1}".format(path, error))
+                return
+            elif error.errno != errno.EEXIST:
+                raise
+        if not os.path.samefile(path, blob_path):
+            self.fetch(checksum_type, checksum, path)
+
+    def collect_garbage(self):
+        """
+        Removes the stored files that are not referenced by any repository,
+        i. e. that have no other hard links.
+
+        @return     The pair of number of removed files and number of freed
+                    bytes.
+        """
+        files_number = 0
+        bytes_number = 0
+        for root, dirs, files in scandir.walk(self._path):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                status = os.lstat(path)
+                if status.st_nlink > 1:
+                    continue
+                logging.debug("Removing unreferenced file {0}".format(path))
+                os.remove(path)
+                files_number += 1
+                bytes_number += status.st_size
+        logging.info("Removed {0} unreferenced files ({1} bytes) from "
+                     "{2}".format(files_number, bytes_number, self._path))
+        return files_number, bytes_number
@@ -0,0 +1,665 @@
+#!/usr/bin/env python2.7
+# -*- coding: utf-8 -*-
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# Copyright (C) Samsung Electronics, 2016
+#
+# 2016         Ilya Palachev                 <i.palachev@samsung.com>
+
+import os
+import sys
+import bz2
+import gzip
+import shutil
+import logging
+import tempfile
+import xml.etree.cElementTree as ET
+from rpmUtils.miscutils import splitFilename, compareEVR, rangeCompare
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+
+"""The XML namespace of repomd.xml file."""
+repo_namespace = "http://linux.duke.edu/metadata/repo"
+"""The XML namespace of primary.xml file."""
+common_namespace = "http://linux.duke.edu/metadata/common"
+"""The XML namespace of RPM-specific elements of primary.xml file."""
+rpm_namespace = "http://linux.duke.edu/metadata/rpm"
+"""The XML namespace of filelists.xml file."""
+filelists_namespace = "http://linux.duke.edu/metadata/filelists"
+
+
+def _tag(namespace, name):
+    """
+    Builds the fully qualified XML tag name.
+
+    @param namespace    The XML namespace.
+    @param name         The local name of tag.
+    @return             The qualified name.
+    """
+    return "{{{0}}}{1}".format(namespace, name)
+
+
+def _intern(string):
+    """
+    Interns the string, so that equal symbols of different packages share
+    the same object.
+
+    @param string   The string.
+    @return         The interned string.
+    """
+    if isinstance(string, str):
+        return intern(string)
+    return string
+
+
+class Package(object):
+    """
+    The package record as it is described in the primary repodata.
+    """
+    __slots__ = ["name", "arch", "epoch", "version", "release", "location",
+                 "size", "checksum_type", "checksum", "provides", "requires",
+                 "files", "other_files"]
+
+    def __init__(self):
+        """
+        Initializes the package record (does nothing).
+        """
+        self.name = None
+        self.arch = None
+        self.epoch = None
+        self.version = None
+        self.release = None
+        self.location = None
+        self.size = None
+        self.checksum_type = None
+        self.checksum = None
+        self.provides = None
+        self.requires = None
+        self.files = None
+        self.other_files = None
+
+    @property
+    def provides_names(self):
+        """The names of symbols provided by the package."""
+        return [symbol for symbol, _, _ in self.provides]
+
+    @property
+    def file_name(self):
+        """The name of RPM file of the package."""
+        return os.path.basename(self.location)
+
+    def __repr__(self):
+        return "{0}-{1}-{2}.{3}".format(self.name, self.version, self.release,
+                                        self.arch)
+
+
+def parse_repomd(content):
+    """
+    Parses the content of repomd.xml file.
+
+    @param content  The content of repomd.xml file.
+    @return         The dictionary that maps data types (e. g. "primary") to
+                    dictionaries with keys "location", "size",
+                    "checksum_type" and "checksum".
+    """
+    root = ET.fromstring(content)
+    records = {}
+    for data in root.findall(_tag(repo_namespace, "data")):
+        record = {}
+        location = data.find(_tag(repo_namespace, "location"))
+        if location is None:
+            logging.warning("Data {0} has no location in "
+                            "repomd.xml".format(data.get("type")))
+            continue
+        record["location"] = location.get("href")
+        checksum = data.find(_tag(repo_namespace, "checksum"))
+        if checksum is not None:
+            record["checksum_type"] = checksum.get("type")
+            record["checksum"] = checksum.text.strip()
+        else:
+            record["checksum_type"] = None
+            record["checksum"] = None
+        size = data.find(_tag(repo_namespace, "size"))
+        if size is not None:
+            record["size"] = int(size.text)
+        else:
+            record["size"] = None
+        records[data.get("type")] = record
+    return records
+
+
+def open_data(path):
+    """
+    Opens the repodata file, decompressing it if needed.
+
+    @param path     The path to the repodata file.
+    @return         The file object.
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def _read_relations(element, tag):
+    """
+    Reads the list of package relations (provides or requires) from the
+    format element of primary.xml.
+
+    @param element  The format element of the package.
+    @param tag      The tag of relations list.
+    @return         The list of tuples (name, flags, (epoch, version,
+                    release)), in the same form as YUM reports them.
+    """
+    relations = []
+    if element is None:
+        return relations
+    entries = element.find(tag)
+    if entries is None:
+        return relations
+    for entry in entries.findall(_tag(rpm_namespace, "entry")):
+        relations.append((_intern(entry.get("name")), entry.get("flags"),
+                          (entry.get("epoch"), entry.get("ver"),
+                           entry.get("rel"))))
+    return relations
+
+
+def read_packages(stream, details=False):
+    """
+    Reads package records from the primary.xml stream. The stream is parsed
+    incrementally, so the whole document is never kept in memory.
+
+    @param stream   The file object with primary.xml content.
+    @param details  Whether provides, requires and files of packages should
+                    be read.
+    @return         The generator of package records.
+    """
+    package_tag = _tag(common_namespace, "package")
+    name_tag = _tag(common_namespace, "name")
+    arch_tag = _tag(common_namespace, "arch")
+    version_tag = _tag(common_namespace, "version")
+    checksum_tag = _tag(common_namespace, "checksum")
+    size_tag = _tag(common_namespace, "size")
+    location_tag = _tag(common_namespace, "location")
+    format_tag = _tag(common_namespace, "format")
+    file_tag = _tag(common_namespace, "file")
+    provides_tag = _tag(rpm_namespace, "provides")
+    requires_tag = _tag(rpm_namespace, "requires")
+    context = ET.iterparse(stream, events=("start", "end"))
+    event, root = next(context)
+    for event, element in context:
+        if event != "end" or element.tag != package_tag:
+            continue
+        if element.get("type") != "rpm":
+            root.clear()
+            continue
+        package = Package()
+        package.name = _intern(element.findtext(name_tag))
+        package.arch = element.findtext(arch_tag)
+        version = element.find(version_tag)
+        package.epoch = version.get("epoch")
+        package.version = version.get("ver")
+        package.release = version.get("rel")
+        checksum = element.find(checksum_tag)
+        package.checksum_type = checksum.get("type")
+        package.checksum = checksum.text.strip()
+        package.size = int(element.find(size_tag).get("package"))
+        package.location = element.find(location_tag).get("href")
+        if details:
+            format_element = element.find(format_tag)
+            package.provides = _read_relations(format_element, provides_tag)
+            package.requires = _read_relations(format_element, requires_tag)
+            package.files = []
+            package.other_files = []
+            if format_element is not None:
+                for file_element in format_element.findall(file_tag):
+                    if file_element.get("type") in [None, "file"]:
+                        package.files.append(file_element.text)
+                    else:
+                        package.other_files.append(file_element.text)
+        # Already processed packages are dropped to keep the memory usage
+        # constant:
+        root.clear()
+        yield package
+
+
+def read_file_lists(stream):
+    """
+    Reads lists of package files from the filelists.xml stream.
+
+    @param stream   The file object with filelists.xml content.
+    @return         The generator of pairs (package checksum, (list of
+                    regular files, list of directories and ghost files)).
+    """
+    package_tag = _tag(filelists_namespace, "package")
+    file_tag = _tag(filelists_namespace, "file")
+    context = ET.iterparse(stream, events=("start", "end"))
+    event, root = next(context)
+    for event, element in context:
+        if event != "end" or element.tag != package_tag:
+            continue
+        files = []
+        other_files = []
+        for file_element in element.findall(file_tag):
+            if file_element.get("type") in [None, "file"]:
+                files.append(file_element.text)
+            else:
+                other_files.append(file_element.text)
+        checksum = element.get("pkgid")
+        root.clear()
+        yield checksum, (files, other_files)
+
+
+def _extract_database(path):
+    """
+    Decompresses the repodata database to the temporary file.
+
+    @param path     The path to the compressed database.
+    @return         The path to the temporary file, or None if the
+                    compression format is not supported.
+    """
+    if path.endswith(".bz2"):
+        source = bz2.BZ2File(path, "rb")
+    elif path.endswith(".gz"):
+        source = gzip.open(path, "rb")
+    elif path.endswith(".sqlite"):
+        source = open(path, "rb")
+    else:
+        return None
+    descriptor, database_path = tempfile.mkstemp(suffix=".sqlite")
+    with os.fdopen(descriptor, "wb") as database, source:
+        shutil.copyfileobj(source, database)
+    return database_path
+
+
+def _query_database(path, query):
+    """
+    Executes the query in the repodata database.
+
+    @param path     The path to the compressed database.
+    @param query    The SQL query.
+    @return         The list of result rows, or None if the database cannot
+                    be read.
+    """
+    database_path = _extract_database(path)
+    if database_path is None:
+        return None
+    try:
+        connection = sqlite3.connect(database_path)
+        connection.text_factory = str
+        try:
+            return [connection.execute(part).fetchall() for part in query]
+        finally:
+            connection.close()
+    except sqlite3.Error as error:
+        logging.warning("Failed to read database {0}: {1}".format(path,
+                                                                  error))
+        return None
+    finally:
+        os.remove(database_path)
+
+
+def read_packages_database(path):
+    """
+    Reads package records with their provides, requires and files from the
+    primary.sqlite database generated by "createrepo --database".
+
+    @param path     The path to the (compressed) database.
+    @return         The list of package records, or None if the database
+                    cannot be read.
+    """
+    query = ["SELECT pkgKey, name, arch, epoch, version, release, "
+             "location_href, size_package, checksum_type, pkgId "
+             "FROM packages",
+             "SELECT pkgKey, name, flags, epoch, version, release "
+             "FROM provides",
+             "SELECT pkgKey, name, flags, epoch, version, release "
+             "FROM requires",
+             "SELECT pkgKey, name, type FROM files"]
+    result = _query_database(path, query)
+    if result is None:
+        return None
+    rows_packages, rows_provides, rows_requires, rows_files = result
+    packages = {}
+    for row in rows_packages:
+        package = Package()
+        (key, package.name, package.arch, package.epoch, package.version,
+         package.release, package.location, package.size,
+         package.checksum_type, package.checksum) = row
+        package.name = _intern(package.name)
+        package.provides = []
+        package.requires = []
+        package.files = []
+        package.other_files = []
+        packages[key] = package
+    for rows, attribute in [(rows_provides, "provides"),
+                            (rows_requires, "requires")]:
+        for key, name, flags, epoch, version, release in rows:
+            package = packages.get(key)
+            if package is not None:
+                getattr(package, attribute).append(
+                    (_intern(name), flags, (epoch, version, release)))
+    for key, name, type_ in rows_files:
+        package = packages.get(key)
+        if package is not None:
+            if type_ == "file":
+                package.files.append(name)
+            else:
+                package.other_files.append(name)
+    return [packages[key] for key in sorted(packages.keys())]
+
+
+def read_file_lists_database(path):
+    """
+    Reads lists of package files from the filelists.sqlite database.
+
+    @param path     The path to the (compressed) database.
+    @return         The dictionary that maps package checksums to pairs
+                    (list of regular files, list of directories and ghost
+                    files), or None if the database cannot be read.
+    """
+    query = ["SELECT packages.pkgId, filelist.dirname, filelist.filenames, "
+             "filelist.filetypes FROM filelist JOIN packages "
+             "ON filelist.pkgKey = packages.pkgKey"]
+    result = _query_database(path, query)
+    if result is None:
+        return None
+    file_lists = {}
+    for checksum, directory, names, types in result[0]:
+        files, other_files = file_lists.setdefault(checksum, ([], []))
+        for name, type_ in zip(names.split("/"), types):
+            path = "{0}/{1}".format(directory, name)
+            if type_ == "f":
+                files.append(path)
+            else:
+                other_files.append(path)
+    return file_lists
+
+
+def read_packages_checksums(repository_path):
+    """
+    Reads checksums and locations of all packages of the repository. Unlike
+    the repomd.xml, they do not change when the repodata is regenerated for
+    the same packages, so they identify the content of the repository.
+
+    @param repository_path  The path to the repository.
+    @return                 The sorted list of pairs (checksum, location), or
+                            None if the repository has no repodata.
+    """
+    repomd_path = os.path.join(repository_path, "repodata", "repomd.xml")
+    if not os.path.isfile(repomd_path):
+        return None
+    with open(repomd_path, "rb") as repomd:
+        records = parse_repomd(repomd.read())
+    checksums = None
+    if sqlite3 is not None and "primary_db" in records:
+        result = _query_database(
+            os.path.join(repository_path, records["primary_db"]["location"]),
+            ["SELECT pkgId, location_href FROM packages"])
+        if result is not None:
+            checksums = result[0]
+    if checksums is None:
+        if "primary" not in records:
+            return None
+        with open_data(os.path.join(repository_path,
+                                    records["primary"]["location"])) as data:
+            checksums = [(package.checksum, package.location) for package
+                         in read_packages(data)]
+    return sorted(checksums)
+
+
+class RepositoryMetadata(object):
+    """
+    The metadata of the local repository that is needed for dependency
+    resolution: names, provides, requires and files of packages. It is read
+    directly from the repodata, the databases generated by
+    "createrepo --database" are used when they are available.
+    """
+    def __init__(self, repository_path, arches=None, file_lists=True):
+        """
+        Reads the metadata of the repository.
+
+        @param repository_path  The path to the repository.
+        @param arches           The list of architectures of packages to be
+                                read, all packages are read if it is None.
+        @param file_lists       Whether the complete file lists should be
+                                read, otherwise they are read only when some
+                                file requirement cannot be resolved with
+                                files listed in the primary data.
+        """
+        repomd_path = os.path.join(repository_path, "repodata", "repomd.xml")
+        with open(repomd_path, "rb") as repomd:
+            records = parse_repomd(repomd.read())
+        self._repository_path = repository_path
+        packages = None
+        if sqlite3 is not None and "primary_db" in records:
+            packages = read_packages_database(self.__get_data_path(
+                records["primary_db"]))
+        if packages is None:
+            if "primary" not in records:
+                logging.error("No primary data in {0}".format(repomd_path))
+                sys.exit("Error.")
+            with open_data(self.__get_data_path(records["primary"])) as data:
+                packages = list(read_packages(data, details=True))
+        if arches is not None:
+            packages = [package for package in packages
+                        if package.arch in arches]
+        self._records = records
+        self._packages = packages
+        self._packages_ids = dict((package, package_id) for package_id, package
+                                  in enumerate(packages))
+        self._removed_ids = set()
+        self._file_lists_read = False
+        if file_lists:
+            self.__read_file_lists()
+        self.__build_index()
+        logging.debug("Read {0} packages from {1}".format(len(packages),
+                                                          repository_path))
+
+    def __get_data_path(self, record):
+        """
+        Gets the path to the repodata file.
+
+        @param record   The record of repomd.xml for the file.
+        @return         The path to the file.
+        """
+        return os.path.join(self._repository_path, record["location"])
+
+    def __read_file_lists(self):
+        """
+        Reads the complete file lists of packages, the primary data contains
+        only files from commonly required directories.
+        """
+        records = self._records
+        file_lists = None
+        if sqlite3 is not None and "filelists_db" in records:
+            file_lists = read_file_lists_database(self.__get_data_path(
+                records["filelists_db"]))
+        if file_lists is None and "filelists" in records:
+            with open_data(self.__get_data_path(records["filelists"])) as data:
+                file_lists = dict(read_file_lists(data))
+        if file_lists is not None:
+            for package in self._packages:
+                files = file_lists.get(package.checksum)
+                if files is not None:
+                    package.files, package.other_files = files
+        self._file_lists_read = True
+
+    @property
+    def file_lists_read(self):
+        """Whether the complete file lists of packages have been read."""
+        return self._file_lists_read
+
+    def __build_index(self):
+        """
+        Builds the index of provided symbols and files in one pass over the
+        repository. Symbols are mapped to tuples (package ID, flags, (epoch,
+        version, release)) of their provides, files are mapped to package
+        IDs.
+        """
+        provides = {}
+        files = {}
+        for package_id, package in enumerate(self._packages):
+            for symbol, flags, evr in package.provides:
+                provides.setdefault(symbol, []).append((package_id, flags, evr))
+            # Directories and ghost files are not installed as regular files,
+            # but they satisfy requirements on their paths as well:
+            for file_name in package.files + package.other_files:
+                files.setdefault(file_name, []).append(package_id)
+        self._provides = provides
+        self._files = files
+
+    def get_packages(self):
+        """
+        Gets the list of packages in the repository.
+
+        @return         The list of package records.
+        """
+        return [package for package_id, package in enumerate(self._packages)
+                if package_id not in self._removed_ids]
+
+    def remove_package(self, package):
+        """
+        Removes the package from the metadata, so that it is never found as
+        a provider.
+
+        @param package  The package record.
+        """
+        self._removed_ids.add(self._packages_ids[package])
+
+    def __get_provider_ids(self, symbol):
+        """
+        Gets IDs of packages that provide the given symbol or file.
+
+        @param symbol   The symbol name or the file path.
+        @return         The list of triples (package ID, flags, (epoch,
+                        version, release)), flags are None for files.
+        """
+        entries = self._provides.get(symbol)
+        if entries is None:
+            entries = [(package_id, None, (None, None, None)) for package_id
+                       in self._files.get(symbol, [])]
+        return [entry for entry in entries
+                if entry[0] not in self._removed_ids]
+
+    def search_providers(self, symbol):
+        """
+        Searches packages that provide the given symbol or file.
+
+        @param symbol   The symbol name or the file path.
+        @return         The list of provider packages.
+        """
+        providers = []
+        for package_id, _, _ in self.__get_provider_ids(symbol):
+            package = self._packages[package_id]
+            if package not in providers:
+                providers.append(package)
+        return providers
+
+    def resolve_requirements(self, requirements):
+        """
+        Resolves the requirements in bulk. Each distinct requirement is
+        looked up in the index once, versioned requirements are matched
+        against versions of provides. If no provide satisfies the version,
+        all providers of the symbol are reported, as YUM did.
+
+        @param requirements     The iterable of requirements in the form
+                                (name, flags, (epoch, version, release)).
+        @return                 The dictionary that maps requirements to
+                                lists of provider packages.
+        """
+        requirements = set(requirements)
+        if not self._file_lists_read:
+            for name, _, _ in requirements:
+                if name.startswith("/") and len(self.__get_provider_ids(
+                        name)) == 0:
+                    logging.debug("File {0} is not found in the primary "
+                                  "data, file lists will be read".format(name))
+                    self.__read_file_lists()
+                    self.__build_index()
+                    break
+        resolved = {}
+        for requirement in requirements:
+            name, flags, _ = requirement
+            entries = self.__get_provider_ids(name)
+            if flags is not None:
+                matching = [entry for entry in entries
+                            if rangeCompare(requirement, (name,) + entry[1:])]
+                if len(matching) > 0:
+                    entries = matching
+            providers = []
+            for package_id, _, _ in entries:
+                package = self._packages[package_id]
+                if package not in providers:
+                    providers.append(package)
+            resolved[requirement] = providers
+        return resolved
+
+
+def get_package_nevra(package):
+    """
+    Gets the identification of the package record.
+
+    @param package  The package record.
+    @return         The tuple (name, arch, epoch, version, release).
+    """
+    return (package.name, package.arch, package.epoch, package.version,
+            package.release)
+
+
+def get_file_nevra(file_name):
+    """
+    Gets the identification of the package from the name of its RPM file.
+
+    @param file_name    The name of RPM file.
+    @return             The tuple (name, arch, epoch, version, release).
+    """
+    name, version, release, epoch, arch = splitFilename(
+        os.path.basename(file_name))
+    return (name, arch, epoch, version, release)
+
+
+def select_newest(packages, get_nevra=get_package_nevra):
+    """
+    Selects the newest packages among packages with the same name and
+    architecture. Versions are compared as RPM does it, e. g. 1.10 is newer
+    than 1.9.
+
+    @param packages     The list of packages.
+    @param get_nevra    The function that returns the tuple
+                        (name, arch, epoch, version, release) for the
+                        package.
+    @return             The pair of lists of selected and dropped packages.
+    """
+    newest = {}
+    dropped = []
+    for index, package in enumerate(packages):
+        name, arch, epoch, version, release = get_nevra(package)
+        evr = (epoch or "0", version, release)
+        key = (name, arch)
+        if key in newest:
+            _, package_other, evr_other = newest[key]
+            logging.debug("Select between {0} and {1}".format(package,
+                                                              package_other))
+            if compareEVR(evr, evr_other) <= 0:
+                dropped.append(package)
+                continue
+            dropped.append(package_other)
+        newest[key] = (index, package, evr)
+    # The initial order of packages is kept:
+    selected = [package for _, package, _ in sorted(newest.values())]
+    return selected, dropped
@@ -22,6 +22,10 @@ import os
 import stat
 import shutil
 import sys
+import errno
+import fcntl
+import tempfile
+import time
 import logging
 import re
 from sets import Set
@@ -32,13 +36,17 @@ import hidden_subprocess
 import multiprocessing
 import base64
 import difflib
+import hashlib
+import igraph
 import xml.etree.ElementTree as ET
 from rpmUtils.miscutils import splitFilename
 import mic.kickstart
 from mic.utils.misc import get_pkglist_in_comps
-from dependency_graph_builder import DependencyGraphBuilder
+import dependency_graph_builder
+from dependency_graph_builder import DependencyGraphBuilder, DependencyGraph
 import temporaries
 import files
+import repodata
 import check
 import rpm_patcher
 from repository import Repository, RepositoryData
@@ -48,6 +56,7 @@ from repository_manager import RepositoryManager
 
 
 repodata_regeneration_enabled = False
+garbage_collection_enabled = False
 target_arhcitecture = None
 jobs_number = 1
 repository_cache_directory_path = None
@@ -55,54 +64,76 @@ mic_config_path = None
 libasan_preloading = True
 
 
-def build_forward_dependencies(graph, package):
+"""The path to the cache of combined repositories."""
+combined_repository_cache_path = None
+
+
+"""The number of recently used combined repositories that are kept in the
+cache."""
+combined_repositories_number = 8
+
+
+"""The time in seconds after which combined repositories that have not been
+completed are removed from the cache."""
+combined_repository_grace_period = 3600
+
+
+"""The descriptors of cached combined repositories used by this run. They are
+kept open, so that the repositories stay locked until the exit."""
+_combined_repositories_locks = []
+
+
+def get_package_ids(graph, packages):
     """
-    Builds the set of forward dependencies of the package.
+    Gets IDs of the given packages in the dependency graph.
 
     @param graph        The dependency graph of the repository.
-    @param package      The name of package.
+    @param packages     The names of packages.
 
-    @return             The set of forward dependencies + package itself
+    @return             The list of IDs of packages that are found.
     """
-    source = graph.get_name_id(package)
-    logging.debug("Found id = {0} for package {1}".format(source, package))
-    if source is None:
-        logging.debug("Failed to find package {0} in dependency "
-                      "tree.".format(package))
-        return Set()
-    dependencies = Set()
-    for vertex in graph.bfsiter(source):
-        dependency = graph.vs[vertex.index]["name"]
-        logging.debug("Processing vertex {0}, its name is "
-                      "{1}".format(vertex.index, dependency))
-        dependencies.add(dependency)
-    return dependencies
+    ids = []
+    for package in packages:
+        id_ = graph.get_name_id(package)
+        if id_ is None:
+            logging.debug("Failed to find package {0} in dependency "
+                          "tree.".format(package))
+        else:
+            ids.append(id_)
+    return ids
 
 
-def build_package_set(graph, back_graph, package_names):
+def build_package_set(graph, package_names, condensation=None):
     """
     Builds the set of marked packages.
 
     @param graph            The dependency graph of the repository.
-    @param back_graph       The backward dependency graph of the repository.
     @param package_names    The package names.
+    @param condensation     The condensation of the graph used to speed up
+                            the traversal.
 
     @return                 The set of marked packages.
     """
-    marked = Set()
-    for package in package_names["forward"]:
-        marked = marked | build_forward_dependencies(graph, package)
-    for package in package_names["backward"]:
-        marked = marked | build_forward_dependencies(back_graph, package)
+    # Both closures are computed with one traversal each, names are taken
+    # only for marked vertices:
+    marks_forward = graph.get_reachable(
+        get_package_ids(graph, package_names["forward"]), igraph.OUT,
+        condensation)
+    marks_backward = graph.get_reachable(
+        get_package_ids(graph, package_names["backward"]), igraph.IN,
+        condensation)
+    names = graph.vs["name"]
+    marked = Set([names[i] for i in xrange(len(names))
+                  if marks_forward[i] or marks_backward[i]])
     for package in package_names["single"]:
         if not graph.get_name_id(package) is None:
-            marked = marked | Set([package])
+            marked.add(package)
     for package in package_names["excluded"]:
         if not graph.get_name_id(package) is None:
-            marked = marked - Set([package])
+            marked.discard(package)
     for package in package_names["service"]:
         if not graph.get_name_id(package) is None:
-            marked = marked | Set([package])
+            marked.add(package)
 
     for package in marked:
         logging.debug("Package {0} is marked".format(package))
@@ -158,64 +189,64 @@ def check_rpm_versions(graph, marked_graph, packages, if_skip_mismatch = False):
         sys.exit("Error.")
 
 
-def get_requirements_updates(package_name, requirements_tuples,
-                             requirements_marked_tuples):
-    """
-    Gets the list of requirements that should be updated in the marked RPM
-    package.
-
-    @param package_name                 The name of RPM package.
-    @param requirements_tuples          The list of requirements of the
-                                        original package.
-    @param requirements_tuples_marked   The list of requirements of the marked
-                                        package.
-    @return                             The list of requirements of the
-                                        original package that are different
-                                        from marked ones.
-    """
-    logging.debug("Processing requirements of package "
-                  "{0}".format(package_name))
-    requirements = {}
-    for requirement_tuple in requirements_tuples:
-        symbol, relation, numbers = requirement_tuple
-        epoch, version, release = numbers
-        requirements[symbol] = (relation, epoch, version, release)
-    requirements_marked = {}
-    for requirement_tuple in requirements_marked_tuples:
-        symbol, relation, numbers = requirement_tuple
-        epoch, version, release = numbers
-        requirements_marked[symbol] = (relation, epoch, version, release)
-
-    updates = []
-    for symbol in requirements.keys():
-        if symbol not in requirements_marked.keys():
-            logging.warning("  Marked package \"{0}\" has lost requirement "
-                            "\"{1}\"".format(package_name, symbol))
-            updates.append(("add", symbol, requirements[symbol]))
+def get_requirements_updates(graph, marked_graph, packages):
+    """
+    Gets the lists of requirements that should be updated in the marked RPM
+    packages.
+
+    @param graph            Dependency graph of the non-marked repository
+    @param marked_graph     Dependency graph of the marked repository
+    @param packages         The names of marked packages.
+    @return                 The dictionary that maps names of packages to
+                            lists of requirements of original packages that
+                            are different from marked ones (packages without
+                            such requirements are not included).
+    """
+    table = graph.get_requirements_table()
+    table_marked = marked_graph.get_requirements_table()
+    packages_updates = {}
+    for package in packages:
+        package_id = graph.get_name_id(package)
+        marked_package_id = marked_graph.get_name_id(package)
+        if package_id is None or marked_package_id is None:
             continue
-        for i in range(len(requirements[symbol])):
-            if requirements[symbol][i] != requirements_marked[symbol][i]:
+        requirements = table[package_id]
+        requirements_marked = table_marked[marked_package_id]
+        # Requirements of most packages are the same, so whole rows are
+        # compared first:
+        if requirements == requirements_marked:
+            continue
+        logging.debug("Processing requirements of package "
+                      "{0}".format(package))
+        updates = []
+        for symbol, requirement in requirements.iteritems():
+            requirement_marked = requirements_marked.get(symbol)
+            if requirement_marked is None:
+                logging.warning("  Marked package \"{0}\" has lost "
+                                "requirement \"{1}\"".format(package, symbol))
+                updates.append(("add", symbol, requirement))
+            elif requirement != requirement_marked:
                 logging.debug("  Detected difference in requirement "
                               "{0}:".format(symbol))
-                logging.debug("   * {0}".format(requirements[symbol]))
-                logging.debug("   * {0}".format(requirements_marked[symbol]))
-                updates.append(("change", symbol, requirements[symbol]))
-                break
-    for symbol in requirements_marked.keys():
-        if symbol not in requirements.keys():
-            logging.debug("  Marked-specific requirement: "
-                          "{0} {1}".format(symbol,
-                                           requirements_marked[symbol]))
-    if len(updates) > 0:
-        logging.debug("  Found {0} updates".format(len(updates)))
-    return updates
+                logging.debug("   * {0}".format(requirement))
+                logging.debug("   * {0}".format(requirement_marked))
+                updates.append(("change", symbol, requirement))
+        for symbol, requirement_marked in requirements_marked.iteritems():
+            if symbol not in requirements:
+                logging.debug("  Marked-specific requirement: "
+                              "{0} {1}".format(symbol, requirement_marked))
+        if len(updates) > 0:
+            logging.debug("  Found {0} updates".format(len(updates)))
+            packages_updates[package] = updates
+    return packages_updates
 
 
 def construct_combined_repository(graph, marked_graph, marked_packages,
-                                  if_mirror, rpm_patcher, if_skip_mismatch = False):
+                                  if_mirror, rpm_patcher,
+                                  repository_path = None):
     """
-    Constructs the temporary repository that consists of symbolic links to
-    packages from non-marked and marked repositories.
+    Constructs the temporary repository that consists of links to packages
+    from non-marked and marked repositories (see files.place_file).
 
     @param graph            Dependency graph of the non-marked repository
     @param marked_graph     Dependency graph of the marked repository
@@ -223,13 +254,18 @@ def construct_combined_repository(graph, marked_graph, marked_packages,
     @param if_mirror        Whether to mirror not found marked packages from
                             non-marked repository
     @param rpm_patcher      The patcher of RPMs.
+    @param repository_path  The path to the directory where the repository
+                            is constructed (the temporary one is created if
+                            it is not given).
 
     @return                 The path to the constructed combined repository.
     """
-    check_rpm_versions(graph, marked_graph, marked_packages, if_skip_mismatch)
-    repository_path = temporaries.create_temporary_directory("combirepo")
+    if repository_path is None:
+        repository_path = temporaries.create_temporary_directory("combirepo")
     packages_not_found = []
     copy_tasks = []
+    packages_updates = get_requirements_updates(graph, marked_graph,
+                                                marked_packages)
 
     for package in marked_packages:
         marked_package_id = marked_graph.get_name_id(package)
@@ -253,9 +289,7 @@ def construct_combined_repository(graph, marked_graph, marked_packages,
                               "{1} and {2}".format(package, release,
                                                    release_marked))
                 if_patching_needed = True
-            updates = get_requirements_updates(
-                package, graph.vs[package_id]["requirements"],
-                marked_graph.vs[marked_package_id]["requirements"])
+            updates = packages_updates.get(package, [])
             if len(updates) > 0:
                 logging.debug("Requirements updates are necessary.")
                 if_patching_needed = True
@@ -288,7 +322,8 @@ def construct_combined_repository(graph, marked_graph, marked_packages,
         location_from = graph.vs[package_id]["location"]
         copy_tasks.append((package, location_from, repository_path))
 
-    hidden_subprocess.function_call_list("Copying", shutil.copy, copy_tasks)
+    hidden_subprocess.function_call_list("Linking", files.place_file,
+                                         copy_tasks)
 
     if logging.getLogger().getEffectiveLevel() == logging.DEBUG:
         hidden_subprocess.silent_call(["ls", "-l", repository_path])
@@ -376,39 +411,222 @@ def inform_about_unprovided(provided_symbols, unprovided_symbols,
                         " {0}, but none of them provides it.".format(symbol))
 
 
-def build_graphs(repository_pair, builder, parameters):
+def build_graph_state(builder, repository_path, architecture, preferables,
+                      strategy, packages_list):
     """
-    Builds three dependency graphs (forward, backward and marked forward)
-    for the given repository pair.
+    Builds the dependency graph of the repository. It is called in worker
+    processes, so the graph is returned in the serializable form.
 
-    @param repository_pair      Teh repository pair.
     @param builder              The dependency graph builder.
-    @param parameters           The parameters of the repository combiner.
+    @param repository_path      The path to the repository.
+    @param architecture         The architecture to be analyzed.
+    @param preferables          The list of preferable package names.
+    @param strategy             The strategy for the "have choice" problem.
+    @param packages_list        The list of packages to be downloaded.
+    @return                     The state of the forward dependency graph.
+    """
+    graph = builder.build_graph(repository_path, architecture, preferables,
+                                strategy, packages_list)
+    return graph.get_state()
+
+
+def build_graphs(repository_pairs, builder, parameters):
     """
-    repository_name = repository_pair.name
-    check.directory_exists(repository_pair.url)
-    check.directory_exists(repository_pair.url_marked)
+    Builds two dependency graphs (original and marked) for each of the given
+    repository pairs. Graphs are built in parallel
+    processes.
 
+    @param repository_pairs     The list of repository pairs.
+    @param builder              The dependency graph builder.
+    @param parameters           The parameters of the repository combiner.
+    @return                     The dictionary that maps repository names to
+                                pairs of graphs.
+    """
     strategy = parameters.preferring_strategy
     preferables = parameters.package_names["preferable"]
-    graph, back_graph = builder.build_graph(repository_pair.url,
-                                            parameters.architecture,
-                                            preferables, strategy,
-                                            parameters.packages_list)
-    # Generally speaking, sets of packages in non-marked and marked
-    # repositories can differ. That's why we need to build graphs also for
-    # marked repository.
-    # Nevertheless we assume that graph of marked repository is isomorphic
-    # to some subgraph of the non-marked repository graph.
-    # FIXME: If it's not true in some pratical cases, then the special
-    # treatment is needed.
-
-    marked_graph, _ = builder.build_graph(repository_pair.url_marked,
-                                          parameters.architecture,
-                                          preferables,
-                                          strategy,
-                                          parameters.packages_list)
-    return graph, back_graph, marked_graph
+    tasks = []
+    for repository_pair in repository_pairs:
+        check.directory_exists(repository_pair.url)
+        check.directory_exists(repository_pair.url_marked)
+        # Generally speaking, sets of packages in non-marked and marked
+        # repositories can differ. That's why we need to build graphs also
+        # for marked repository.
+        # Nevertheless we assume that graph of marked repository is
+        # isomorphic to some subgraph of the non-marked repository graph.
+        # FIXME: If it's not true in some pratical cases, then the special
+        # treatment is needed.
+        for name, path in [(repository_pair.name, repository_pair.url),
+                           ("{0} (marked)".format(repository_pair.name),
+                            repository_pair.url_marked)]:
+            tasks.append((name, builder, path, parameters.architecture,
+                          preferables, strategy, parameters.packages_list))
+    states = hidden_subprocess.function_call_list_parallel(
+        "Building graphs", build_graph_state, tasks, jobs_number)
+    graphs = {}
+    for repository_pair in repository_pairs:
+        state = states.pop(0)
+        marked_state = states.pop(0)
+        graph = DependencyGraph.from_state(state)
+        marked_graph = DependencyGraph.from_state(marked_state)
+        graphs[repository_pair.name] = (graph, marked_graph)
+    return graphs
+
+
+def get_repository_content_key(repository_path):
+    """
+    Gets the key that identifies the content of the repository. The
+    repomd.xml is not used as is, because it changes each time the repodata
+    is regenerated, even for the same packages.
+
+    @param repository_path  The path to the repository.
+    @return                 The key.
+    """
+    with open(os.path.join(repository_path, "repodata", "repomd.xml"),
+              "rb") as repomd:
+        records = repodata.parse_repomd(repomd.read())
+    # Checksums of compressed data and of databases change with the
+    # regeneration, but group and patterns files are kept as they are:
+    data_checksums = sorted(
+        (data_type, record["checksum"]) for data_type, record
+        in records.iteritems()
+        if data_type not in ["primary", "filelists", "other"] and
+        not data_type.endswith(("_gz", "_db", "_zck")))
+    return [repodata.read_packages_checksums(repository_path),
+            data_checksums]
+
+
+def get_combined_repository_name(repository_pair, graphs, marked_packages,
+                                 parameters):
+    """
+    Gets the name of combined repository in the cache. It is derived from
+    snapshots of both repositories, packages selected to their graphs, the
+    set of marked packages and options of patching, i. e. from everything
+    the content of the combined repository depends on.
+
+    @param repository_pair      The repository pair.
+    @param graphs               The pair of dependency graphs of the original
+                                and marked repositories.
+    @param marked_packages      The set of marked package names.
+    @param parameters           The parameters of the repository combiner.
+    @return                     The name of combined repository.
+    """
+    graph, marked_graph = graphs
+    locations_marked = []
+    for package in marked_packages:
+        package_id = marked_graph.get_name_id(package)
+        if package_id is not None:
+            locations_marked.append(
+                marked_graph.vs[package_id]["location"])
+    key = [get_repository_content_key(repository_pair.url),
+           get_repository_content_key(repository_pair.url_marked),
+           os.path.abspath(repository_pair.url),
+           os.path.abspath(repository_pair.url_marked),
+           sorted(graph.vs["location"]), sorted(locations_marked),
+           sorted(marked_packages), parameters.mirror_mode,
+           rpm_patcher.developer_disable_patching]
+    return hashlib.sha256(repr(key)).hexdigest()
+
+
+def lock_combined_repository(repository_path, if_exclusive=False):
+    """
+    Locks the combined repository in the cache. Runs that use the repository
+    hold the shared lock until the exit, the exclusive lock is taken only to
+    remove the repository, so that repositories in use are never removed.
+
+    @param repository_path  The path to the combined repository.
+    @param if_exclusive     Whether the exclusive lock should be taken.
+    @return                 The descriptor of the locked directory, or None
+                            if the repository does not exist or the
+                            exclusive lock cannot be taken now.
+    """
+    try:
+        descriptor = os.open(repository_path, os.O_RDONLY)
+    except OSError as error:
+        if error.errno == errno.ENOENT:
+            return None
+        raise
+    if if_exclusive:
+        try:
+            fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(descriptor)
+            return None
+    else:
+        fcntl.flock(descriptor, fcntl.LOCK_SH)
+    return descriptor
+
+
+def remove_combined_repository(repository_path):
+    """
+    Removes the combined repository from the cache if it is not used by any
+    run.
+
+    @param repository_path  The path to the combined repository.
+    @return                 True if the repository has been removed.
+    """
+    descriptor = lock_combined_repository(repository_path, True)
+    if descriptor is None:
+        return False
+    logging.debug("Removing combined repository {0} from "
+                  "cache".format(repository_path))
+    files.safe_rmtree(repository_path)
+    os.close(descriptor)
+    return True
+
+
+def check_combined_repository(repository_path):
+    """
+    Checks that the cached combined repository is complete and all packages
+    it links to still exist.
+
+    @param repository_path  The path to the combined repository.
+    @return                 True if the repository can be used.
+    """
+    if rpm_patcher.drop_patching_cache:
+        # Packages are patched again, so they are not taken from the cache:
+        return False
+    if not os.path.isfile(os.path.join(repository_path, "repodata",
+                                       "repomd.xml")):
+        return False
+    for file_name in os.listdir(repository_path):
+        if not os.path.exists(os.path.join(repository_path, file_name)):
+            logging.debug("Broken link {0} in {1}".format(file_name,
+                                                          repository_path))
+            return False
+    return True
+
+
+def remove_unused_combined_repositories(used_paths):
+    """
+    Removes combined repositories from the cache except the recently used
+    ones and ones used by other runs. Repositories that have not been
+    completed are removed when they are not locked by the runs that
+    construct them.
+
+    @param used_paths   The paths to repositories used in this run.
+    """
+    global combined_repository_cache_path
+    global combined_repositories_number
+    global combined_repository_grace_period
+    deadline = time.time() - combined_repository_grace_period
+    paths = {}
+    for name in os.listdir(combined_repository_cache_path):
+        path = os.path.join(combined_repository_cache_path, name)
+        if path in used_paths:
+            continue
+        try:
+            modification_time = os.path.getmtime(path)
+        except OSError:
+            # It has been removed by the concurrent run:
+            continue
+        if not name.endswith(".partial"):
+            paths[path] = modification_time
+        elif modification_time < deadline:
+            remove_combined_repository(path)
+    paths = sorted(paths.keys(), key=paths.get, reverse=True)
+    number_kept = max(combined_repositories_number - len(used_paths), 0)
+    for path in paths[number_kept:]:
+        remove_combined_repository(path)
 
 
 def process_repository_pair(repository_pair, graphs, parameters,
@@ -421,9 +639,13 @@ def process_repository_pair(repository_pair, graphs, parameters,
     @param parameters           The parameters of the repository combiner.
     @param rpm_patcher          The patcher of RPMs.
 
-    @return                     Path to combined repository.
+    @return                     The tuple of path to combined repository,
+                                set of marked packages and the path where
+                                the repository is kept in the cache (None
+                                if it is not cached), both paths are the
+                                same if it is taken from the cache.
     """
-    graph, back_graph, marked_graph = graphs
+    graph, marked_graph = graphs
     inform_about_unprovided(graph.provided_symbols, graph.unprovided_symbols,
                             marked_graph.provided_symbols,
                             marked_graph.unprovided_symbols)
@@ -439,16 +661,45 @@ def process_repository_pair(repository_pair, graphs, parameters,
                 logging.debug("!!! Package {0} is NOT marked "
                               "!!!".format(package))
     else:
-        marked_packages = build_package_set(graph, back_graph,
-                                            parameters.package_names)
+        marked_packages = build_package_set(graph, parameters.package_names,
+                                            graph.get_condensation())
+    # The versions are checked before the cache is looked up, because the
+    # repository from the cache can be built with --skip-version-mismatch:
+    check_rpm_versions(graph, marked_graph, marked_packages,
+                       parameters.skip_mismatch)
+    cached_path = None
+    partial_path = None
+    global combined_repository_cache_path
+    global _combined_repositories_locks
+    if combined_repository_cache_path is not None:
+        name = get_combined_repository_name(repository_pair, graphs,
+                                            marked_packages, parameters)
+        cached_path = os.path.join(combined_repository_cache_path, name)
+        descriptor = lock_combined_repository(cached_path)
+        if descriptor is not None:
+            if check_combined_repository(cached_path):
+                logging.info("Using combined repository {0} from "
+                             "cache".format(cached_path))
+                _combined_repositories_locks.append(descriptor)
+                os.utime(cached_path, None)
+                return cached_path, marked_packages, cached_path
+            os.close(descriptor)
+            remove_combined_repository(cached_path)
+        # The repository gets its name only when it is complete, so that
+        # interrupted runs do not leave broken repositories in the cache:
+        partial_path = tempfile.mkdtemp(prefix=name, suffix=".partial",
+                                        dir=combined_repository_cache_path)
+        os.chmod(partial_path, 0777)
+        _combined_repositories_locks.append(
+            lock_combined_repository(partial_path))
     mirror_mode = parameters.mirror_mode
     combined_repository_path = construct_combined_repository(graph,
                                                              marked_graph,
                                                              marked_packages,
                                                              mirror_mode,
                                                              rpm_patcher,
-                                                             parameters.skip_mismatch)
-    return combined_repository_path, marked_packages
+                                                             partial_path)
+    return combined_repository_path, marked_packages, cached_path
 
 
 def regenerate_repodata(repository_path, marked_repository_path):
@@ -560,10 +811,8 @@ def construct_combined_repositories(parameters, packages):
     """
     dependency_builder = DependencyGraphBuilder(check_rpm_name, packages)
 
-    graphs = {}
-    for repository_pair in parameters.repository_pairs:
-        graphs[repository_pair.name] = build_graphs(
-            repository_pair, dependency_builder, parameters)
+    graphs = build_graphs(parameters.repository_pairs, dependency_builder,
+                          parameters)
     specified_packages = check_package_names(graphs, parameters.package_names)
 
     # Prepare RPM patching root based on original dependency graphs:
@@ -577,14 +826,18 @@ def construct_combined_repositories(parameters, packages):
         [graphs[key][0] for key in graphs.keys()])
 
     combined_repository_paths = {}
+    cached_paths = {}
     marked_packages_total = Set()
     for repository_pair in parameters.repository_pairs:
         logging.debug(parameters.package_names)
-        path, marked_packages = process_repository_pair(
+        path, marked_packages, cached_path = process_repository_pair(
             repository_pair, graphs[repository_pair.name], parameters,
             patcher)
         marked_packages_total = marked_packages_total | marked_packages
         combined_repository_paths[repository_pair.name] = path
+        # Repositories taken from the cache are used as they are:
+        if path != cached_path:
+            cached_paths[repository_pair.name] = cached_path
 
     excluded_packages = parameters.package_names.get("excluded")
     if excluded_packages is None:
@@ -596,6 +849,8 @@ def construct_combined_repositories(parameters, packages):
                             " of non-marked repositories".format(package))
     patcher.do_tasks()
     for repository_pair in parameters.repository_pairs:
+        if repository_pair.name not in cached_paths:
+            continue
         repository = Repository(repository_pair.url)
         repository.prepare_data()
         repodata = repository.data
@@ -603,6 +858,25 @@ def construct_combined_repositories(parameters, packages):
             combined_repository_paths[repository_pair.name])
         combined_repository.set_data(repodata)
         combined_repository.generate_derived_data()
+        cached_path = cached_paths[repository_pair.name]
+        if cached_path is None:
+            continue
+        # The lock of the directory stays valid after the renaming:
+        try:
+            os.rename(combined_repository_paths[repository_pair.name],
+                      cached_path)
+            combined_repository_paths[repository_pair.name] = cached_path
+        except OSError as error:
+            if error.errno not in [errno.EEXIST, errno.ENOTEMPTY]:
+                raise
+            # The same repository is cached by another run meanwhile, so this
+            # one is used under its temporary name and removed later:
+            logging.debug("Combined repository {0} already "
+                          "exists".format(cached_path))
+    global combined_repository_cache_path
+    if combined_repository_cache_path is not None:
+        remove_unused_combined_repositories(
+            combined_repository_paths.values())
     return [combined_repository_paths[key] for key in
             combined_repository_paths.keys()]
 
@@ -772,22 +1046,28 @@ def prepare_repositories(parameters):
     authenticator = base64.encodestring("{0}:{1}".format(parameters.user,
                                                          parameters.password))
     authenticator = authenticator.replace('\n', '')
-    path = repository_manager.prepare(parameters.sup_repo_url, authenticator,
-                                      parameters.packages_list)
-    parameters.sup_repo_url = path
+    # All repositories are downloaded concurrently:
+    urls = [parameters.sup_repo_url]
+    for repository_pair in repository_pairs:
+        urls.extend([repository_pair.url, repository_pair.url_marked])
+    paths = repository_manager.prepare_all(urls, authenticator,
+                                           parameters.packages_list)
+    parameters.sup_repo_url = paths.pop(0)
     for repository_pair in repository_pairs:
-        path = repository_manager.prepare(repository_pair.url, authenticator,
-                                          parameters.packages_list)
-        repository_pair.url = path
-        path_marked = repository_manager.prepare(repository_pair.url_marked,
-                                                 authenticator,
-                                                 parameters.packages_list)
-        repository_pair.url_marked = path_marked
+        repository_pair.url = paths.pop(0)
+        repository_pair.url_marked = paths.pop(0)
+    if garbage_collection_enabled:
+        repository_manager.collect_garbage()
 
     if repodata_regeneration_enabled:
+        regeneration_tasks = []
         for repository_pair in parameters.repository_pairs:
-            regenerate_repodata(repository_pair.url,
-                                repository_pair.url_marked)
+            regeneration_tasks.append((repository_pair.name,
+                                       repository_pair.url,
+                                       repository_pair.url_marked))
+        hidden_subprocess.function_call_list_parallel(
+            "Regenerating", regenerate_repodata, regeneration_tasks,
+            jobs_number)
     if kickstart_file_path is None or not os.path.isfile(kickstart_file_path):
         kickstart_file_path = get_kickstart_from_repos(repository_pairs,
                                                        kickstart_file_path)
@@ -971,6 +1251,19 @@ def initialize_cache_directories(output_directory_path,
         logging.debug("Created directory for patching cache "
                       "{0}".format(patching_cache_path))
     rpm_patcher.patching_cache_path = patching_cache_path
+    graph_cache_path = os.path.join(temporary_directory_path, "graph_cache")
+    if not os.path.isdir(graph_cache_path):
+        os.makedirs(graph_cache_path)
+        logging.debug("Created directory for graph cache "
+                      "{0}".format(graph_cache_path))
+    dependency_graph_builder.graph_cache_path = graph_cache_path
+    global combined_repository_cache_path
+    combined_repository_cache_path = os.path.join(temporary_directory_path,
+                                                  "combined_cache")
+    if not os.path.isdir(combined_repository_cache_path):
+        os.makedirs(combined_repository_cache_path)
+        logging.debug("Created directory for combined repositories cache "
+                      "{0}".format(combined_repository_cache_path))
 
 
 def combine(parameters):
@@ -19,25 +19,37 @@
 # 2016         Ilya Palachev                 <i.palachev@samsung.com>
 
 import os
-import shutil
+import sys
+import time
+import fcntl
 import tempfile
 import logging
 import re
 import configparser
 import scandir
+from threading import Lock, Thread
 from urllib2 import urlopen
 # Combirepo modules:
 import files
 import check
-from directory_downloader import download_directory
+import hidden_subprocess
+import repodata
+from directory_downloader import download_repository, download_status_callback
+from package_store import PackageStore
 
 
 update_repositories = None
+"""The name of the index file of repository cache."""
+index_name = ".index.conf"
 
 
 class RepositoryManager():
     """
     Simple repository downloader.
+
+    The local copies of repositories are registered in the index file in the
+    cache directory, so that they can be found without walking through the
+    cache.
     """
     def __init__(self, cache_directory, name_checking_function):
         """
@@ -49,12 +61,77 @@ class RepositoryManager():
         """
         check.directory_exists(cache_directory)
         self._cache_directory = cache_directory
-        self._repositories = []
+        self._repositories = {}
         self._name_checking_function = name_checking_function
+        self._lock = Lock()
+        self._package_store = PackageStore(os.path.join(cache_directory,
+                                                        ".store"))
+        self._index_path = os.path.join(cache_directory, index_name)
+
+        if os.path.isfile(self._index_path):
+            self.__read_index()
+        else:
+            logging.info("The index of repository cache is not found, it "
+                         "will be rebuilt.")
+            self.__rebuild_index()
+            with self._lock:
+                self.__write_index()
+
+        global update_repositories
+        for url, repository in self._repositories.iteritems():
+            if (update_repositories is not None and
+                    (url in update_repositories or
+                        "all" in update_repositories)):
+                # The local copy is kept, so that only the changed packages
+                # are downloaded:
+                repository["status"] = "updating"
+                logging.info("Repository for URL {0} will be "
+                             "updated!".format(url))
+            logging.debug("Found repository: {0}".format(repository))
+
+    def __lock_index(self):
+        """
+        Locks the index of repository cache against other combirepo
+        processes that use the same cache. The lock is taken on the separate
+        file, because the index itself is replaced on each write.
+
+        @return         The lock file, the lock is released when it is
+                        closed.
+        """
+        lock_file = open(self._index_path + ".lock", "a")
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        return lock_file
 
-        config_paths = files.find_fast(self._cache_directory,
+    def __read_index(self):
+        """
+        Reads the index of repository cache. Repositories that are already
+        known are not replaced by ones from the index.
+        """
+        parser = configparser.SafeConfigParser()
+        parser.read(self._index_path)
+        for section in parser.sections():
+            path = os.path.join(self._cache_directory, section)
+            if not os.path.isdir(path):
+                logging.debug("Repository {0} from the index does not "
+                              "exist".format(path))
+                continue
+            repository = {}
+            repository["url"] = parser.get(section, "url")
+            repository["path"] = path
+            repository["status"] = parser.get(section, "status")
+            repository["timestamp"] = parser.getfloat(section, "timestamp")
+            repository["size"] = parser.getint(section, "size")
+            self._repositories.setdefault(repository["url"], repository)
+
+    def __rebuild_index(self):
+        """
+        Rebuilds the index of repository cache from configs of repositories.
+        """
+        for name in os.listdir(self._cache_directory):
+            config_path = os.path.join(self._cache_directory, name,
                                        ".repository.conf")
-        for config_path in config_paths:
+            if not os.path.isfile(config_path):
+                continue
             parser = configparser.SafeConfigParser()
             parser.read(config_path)
             if not parser.has_section("repository"):
@@ -78,20 +155,100 @@ class RepositoryManager():
             repository["url"] = url
             repository["path"] = os.path.dirname(config_path)
             repository["status"] = status
-            global update_repositories
-            if (update_repositories is not None and
-                    (url in update_repositories or
-                        "all" in update_repositories)):
-                shutil.rmtree(os.path.dirname(config_path))
-                logging.info("Repository for URL {0} will be "
-                             "updated!".format(url))
-            else:
-                self._repositories.append(repository)
+            repository["timestamp"] = os.path.getmtime(config_path)
+            repository["size"] = 0
+            self._repositories[url] = repository
 
-        for repository in self._repositories:
-            logging.debug("Found repository: {0}".format(repository))
+    def __write_index(self):
+        """
+        Writes the index of repository cache. The index is replaced
+        atomically, so that it is never seen partially written. The caller
+        must hold the lock.
+        """
+        with self.__lock_index():
+            # Other processes could register their repositories after the
+            # index has been read, so they are merged before writing:
+            if os.path.isfile(self._index_path):
+                self.__read_index()
+            parser = configparser.SafeConfigParser()
+            for repository in self._repositories.values():
+                section = os.path.basename(repository["path"])
+                parser.add_section(section)
+                parser.set(section, "url", repository["url"])
+                parser.set(section, "status", repository["status"])
+                parser.set(section, "timestamp",
+                           str(repository.get("timestamp", 0)))
+                parser.set(section, "size", str(repository.get("size", 0)))
+            descriptor, temporary_path = tempfile.mkstemp(
+                prefix=index_name, dir=self._cache_directory)
+            with os.fdopen(descriptor, "wb") as index:
+                parser.write(index)
+            os.rename(temporary_path, self._index_path)
+
+    def __save_repository(self, repository):
+        """
+        Saves the description of the repository to its config and to the
+        index of repository cache.
+
+        @param repository   The repository description.
+        """
+        parser = configparser.SafeConfigParser()
+        parser.add_section('repository')
+        parser.set('repository', 'url', repository["url"])
+        parser.set('repository', 'status', repository["status"])
+        with open(os.path.join(repository["path"],
+                  ".repository.conf"), 'wb') as repository_config:
+            parser.write(repository_config)
+        with self._lock:
+            repository["timestamp"] = time.time()
+            self.__write_index()
+
+    def __find_repository(self, url):
+        """
+        Finds the local copy of the repository with the given URL, or creates
+        the new empty one.
+
+        @param url      The URL of the repository.
+        @return         The repository description.
+        """
+        with self._lock:
+            if (url not in self._repositories and
+                    os.path.isfile(self._index_path)):
+                # The repository could be downloaded by another process:
+                with self.__lock_index():
+                    self.__read_index()
+            if url in self._repositories:
+                repository = self._repositories[url]
+                logging.debug("Repository {0} is found in local copy at "
+                              "{1}".format(url, repository["path"]))
+                return repository
+            repository = {}
+            path_created = tempfile.mkdtemp(suffix="repository",
+                                            prefix="combirepo",
+                                            dir=self._cache_directory)
+            repository["path"] = path_created
+            repository["url"] = url
+            repository["status"] = "empty"
+            repository["timestamp"] = time.time()
+            repository["size"] = 0
+            self._repositories[url] = repository
+            return repository
+
+    def __is_ready(self, url):
+        """
+        Checks whether the repository with the given URL can be used without
+        downloading.
 
-    def prepare(self, url, authenticator, packages_list = None):
+        @param url      The URL of the repository.
+        @return         True if the repository is ready.
+        """
+        if url is None or os.path.isdir(url):
+            return True
+        with self._lock:
+            repository = self._repositories.get(url)
+        return repository is not None and repository["status"] == "ready"
+
+    def __prepare(self, url, authenticator, packages_list):
         """
         Prepares the local copy of the repository that is specified at the
         given url.
@@ -99,84 +256,149 @@ class RepositoryManager():
         @param url              The URL of the repository.
         @param authenticator    The encoded user:password string for download
                                 server.
+        @param packages_list    The list of package names to be downloaded.
+        @return                 The path to the local copy.
         """
         logging.debug("Starting preparation of repo from URL {0}".format(url))
         if url is None:
             return None
         if os.path.isdir(url):
             return url
-        repository_found = None
-        i_repository = 0
-        for repository in self._repositories:
-            if repository["url"] == url:
-                repository_found = repository
-                logging.debug("Repository {0} is found in local copy at "
-                              "{1}".format(url, repository["path"]))
-                break
-            i_repository = i_repository + 1
-        if repository_found is None:
-            repository = {}
-            path_created = tempfile.mkdtemp(suffix="repository",
-                                            prefix="combirepo",
-                                            dir=self._cache_directory)
-            repository["path"] = path_created
-            repository["url"] = url
-            repository["status"] = "empty"
-        else:
-            repository = repository_found
+        repository = self.__find_repository(url)
 
         if repository["status"] == "ready":
             logging.debug("The repository is downloaded and ready to "
                           "be used.")
             return repository["path"]
-        elif repository["status"] == "empty":
-            if repository_found is None:
-                self._repositories.append(repository)
-            else:
-                self._repositories[i_repository] = repository
-            parser = configparser.SafeConfigParser()
-            parser.add_section('repository')
-            parser.set('repository', 'url', url)
-            parser.set('repository', 'status', 'empty')
-            with open(os.path.join(repository["path"],
-                      ".repository.conf"), 'wb') as repository_config:
-                parser.write(repository_config)
+        elif repository["status"] in ["empty", "updating"]:
+            self.__save_repository(repository)
             # Download the repository (if we are here, then it's not ready)
             logging.debug("Downloading directory {0}".format(url))
-            download_directory(repository["url"],
-                               repository["path"],
-                               self._name_checking_function, authenticator,
-                               packages_list)
+            download_repository(repository["url"],
+                                repository["path"],
+                                self._name_checking_function, authenticator,
+                                packages_list, self._package_store)
             self.remove_duplicates(repository["path"])
+            repository["size"] = files.get_directory_size(repository["path"])
             repository["status"] = "ready"
-            parser.set('repository', 'status', 'ready')
-            with open(os.path.join(repository["path"],
-                      ".repository.conf"), 'wb') as repository_config:
-                parser.write(repository_config)
+            self.__save_repository(repository)
 
             return repository["path"]
 
         raise Exception("Impossible happened.")
 
+    def __prepare_safely(self, url, authenticator, packages_list, paths,
+                         errors):
+        """
+        Prepares the repository in the worker thread and saves the result.
+
+        @param url              The URL of the repository.
+        @param authenticator    The encoded user:password string for download
+                                server.
+        @param packages_list    The list of package names to be downloaded.
+        @param paths            The dictionary where the path to the local
+                                copy will be saved.
+        @param errors           The list where the error will be saved.
+        """
+        try:
+            paths[url] = self.__prepare(url, authenticator, packages_list)
+        except BaseException as error:
+            logging.error("Failed to prepare repository {0}: "
+                          "{1}".format(url, error))
+            errors.append(error)
+
+    def __prepare_concurrently(self, urls, authenticator, packages_list,
+                               paths):
+        """
+        Prepares the repositories with the given URLs in separate threads.
+
+        @param urls             The URLs of repositories.
+        @param authenticator    The encoded user:password string for download
+                                server.
+        @param packages_list    The list of package names to be downloaded.
+        @param paths            The dictionary where paths to local copies
+                                will be saved.
+        """
+        errors = []
+        threads = []
+        for url in urls:
+            thread = Thread(target=self.__prepare_safely,
+                            args=(url, authenticator, packages_list, paths,
+                                  errors))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if len(errors) > 0:
+            logging.error("Failed to prepare {0} "
+                          "repositories.".format(len(errors)))
+            sys.exit("Error.")
+
+    def prepare_all(self, urls, authenticator, packages_list=None):
+        """
+        Prepares local copies of the repositories that are specified at the
+        given URLs. Repositories that are not ready are downloaded
+        concurrently.
+
+        @param urls             The URLs of repositories.
+        @param authenticator    The encoded user:password string for download
+                                server.
+        @param packages_list    The list of package names to be downloaded.
+        @return                 The list of paths to local copies in the
+                                same order as URLs.
+        """
+        paths = {}
+        urls_pending = []
+        for url in urls:
+            if url in paths or url in urls_pending:
+                continue
+            if self.__is_ready(url):
+                paths[url] = self.__prepare(url, authenticator, packages_list)
+            else:
+                urls_pending.append(url)
+        if len(urls_pending) > 0:
+            hidden_subprocess.function_call_monitor(
+                self.__prepare_concurrently,
+                (urls_pending, authenticator, packages_list, paths),
+                download_status_callback)
+        return [paths[url] for url in urls]
+
+    def prepare(self, url, authenticator, packages_list=None):
+        """
+        Prepares the local copy of the repository that is specified at the
+        given url.
+
+        @param url              The URL of the repository.
+        @param authenticator    The encoded user:password string for download
+                                server.
+        @param packages_list    The list of package names to be downloaded.
+        @return                 The path to the local copy.
+        """
+        return self.prepare_all([url], authenticator, packages_list)[0]
+
+    def collect_garbage(self):
+        """
+        Removes files from the package store that are not used by any
+        repository anymore.
+        """
+        self._package_store.collect_garbage()
+
     def remove_duplicates(self, repository_path):
-        rpms = dict()
-        for root, dirs, files in scandir.walk(repository_path):
-            for file in files:
-                if file.endswith(".rpm"):
-                    split = file.rsplit('.', 3)
-                    path = os.path.join(root, file)
-                    if split[0] in rpms:
-                        path0 = rpms[split[0]]
-                        logging.debug("Select between {0} and {1}".format(path, path0))
-                        split0 = path0.rsplit('.', 3)
-                        rm_path = ''
-                        if split[1] > split0[1]:
-                            rpms[split[0]] = path
-                            rm_path = os.path.join(repository_path, path0)
-                        else:
-                            rm_path = os.path.join(repository_path, path)
-                        if os.path.exists(rm_path):
-                            logging.debug("Removing {0}".format(rm_path))
-                            os.remove(rm_path)
-                    else:
-                        rpms[split[0]] = path
+        """
+        Removes older versions of packages from the local copy of repository,
+        so that only the newest package with each name and architecture is
+        kept.
+
+        @param repository_path  The path to the local copy of repository.
+        """
+        paths = []
+        for root, dirs, file_names in scandir.walk(repository_path):
+            for file_name in file_names:
+                if file_name.endswith(".rpm"):
+                    paths.append(os.path.join(root, file_name))
+        _, paths_dropped = repodata.select_newest(paths,
+                                                  repodata.get_file_nevra)
+        for path in paths_dropped:
+            logging.debug("Removing {0}".format(path))
+            os.remove(path)
@@ -95,9 +95,8 @@ def prepare_minimal_packages_list(graphs):
     for symbol in symbols:
         if len(providers[symbol]) < 1:
             for graph in graphs:
-                for key in graph.symbol_providers.keys():
-                    logging.debug("{0} : {1}".format(
-                        key, graph.symbol_providers[key]))
+                for key, name in graph.symbol_providers.iteritems():
+                    logging.debug("{0} : {1}".format(key, name))
             logging.error("Failed to find symbol {0}".format(symbol))
             logging.error("size: {0}".format(len(graph.symbol_providers)))
             sys.exit("Error.")